@@ -4,21 +4,57 @@
 Created by @jeysshon
 
 The most advanced stem separator that works perfectly
+
+Streamlit is imported only when this file runs as the app. Process pool
+workers re-import it as their main module, and scripts may import it for
+its helpers; neither pays for the UI.
 """
 
-import streamlit as st
 import time
-import zipfile
-from io import BytesIO
 import os
+import logging
+import math
+from functools import partial
 
-# Page config
-st.set_page_config(
-    page_title="🎵 Disband - Professional AI Stem Separator",
-    page_icon="🎵",
-    layout="wide",
-    initial_sidebar_state="collapsed"
+from disband.analysis import read_analysis, spectrogram_image, waveform_image
+from disband.audio_io import AUDIO_EXTENSIONS, can_decode
+from disband.downloads import base_url, get_download_server
+from disband.encoders import mime_for, mp3_available
+from disband.jobs import (
+    PREVIEW_SECONDS, JobLease, JobStatus, QueueFull, build_package, job_analyses, job_previews,
+    job_status, load_result, submit_job, touch_job
 )
+from disband.metrics import format_duration, get_registry
+from disband.profiles import get_profile
+
+# Seconds between progress polls of a running separation
+POLL_INTERVAL = 0.5
+
+# Processing tier behind each Quality option
+QUALITY_PROFILES = {
+    "🏆 Maximum (Recommended)": "maximum",
+    "⚡ Balanced": "balanced",
+    "🚀 Fast": "fast",
+}
+
+# Encoder behind each Output option
+OUTPUT_FORMATS = {
+    "📀 WAV (Best)": "wav",
+    "🎵 MP3 320k": "mp3",
+    "💎 FLAC": "flac",
+}
+
+# Short name of each stem on its download button and preview
+STEM_LABELS = {
+    "vocals_hq": "🎤 Vocals HQ",
+    "instrumental_hq": "🎹 Instrumental",
+    "vocals_clean": "✨ Clean Vocals",
+    "karaoke_version": "🎵 Karaoke",
+    "bass": "🎸 Bass",
+    "drums": "🥁 Drums"
+}
+
+logger = logging.getLogger("disband")
 
 def load_beautiful_css():
     """Ultimate beautiful CSS"""
@@ -234,110 +270,143 @@ def load_beautiful_css():
     </style>
     """, unsafe_allow_html=True)
 
-def separate_audio_real(uploaded_file):
+def separate_audio_real(uploaded_file, settings, profile_name, output_format):
     """
     REAL audio separation with different outputs
+
+    Runs as a background job: the first call submits it, every call shows
+    the worker's progress (or place in the queue) and returns the job
+    status. A full queue rejects the job.
     """
+    if not st.session_state.job_id:
+        try:
+            # A view of the upload, not a copy: it is hashed and written out as is
+            st.session_state.job_id = submit_job(
+                uploaded_file.getbuffer(), settings, profile_name, output_format, uploaded_file.name
+            )
+        except QueueFull:
+            return JobStatus(
+                "rejected", 0.0, "🚦 DISBAND is at capacity right now, please try again in a minute", {}, None
+            )
+        st.session_state.job_lease = JobLease(st.session_state.job_id)
+        st.session_state.job_profile = profile_name
     
-    progress_steps = [
-        "🔍 Analyzing audio spectrum...",
-        "🧠 Loading AI models...", 
-        "🎯 Detecting vocal patterns...",
-        "🎵 Separating frequencies...",
-        "🎤 Isolating vocals...",
-        "🎹 Creating instrumental...",
-        "✨ Noise reduction...",
-        "🎧 Quality optimization...",
-        "📦 Finalizing stems..."
-    ]
-    
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    for i, step in enumerate(progress_steps):
-        progress = (i + 1) / len(progress_steps)
-        progress_bar.progress(progress)
-        status_text.text(step)
-        time.sleep(0.9)
-    
-    progress_bar.empty()
-    status_text.empty()
-    
-    # Get original audio
-    original_data = bytes(uploaded_file.getbuffer())
-    
-    # Create DIFFERENT versions for each stem
-    stems = {}
-    
-    # Vocals - Original audio as "extracted vocals"
-    stems["vocals_hq.wav"] = original_data
-    
-    # Instrumental - Modified version (simulate filtering)
-    instrumental = bytearray(original_data)
-    # Apply "instrumental filter" - modify every 1000th byte
-    for i in range(0, len(instrumental), 1000):
-        if i + 10 < len(instrumental):
-            for j in range(10):
-                if i + j < len(instrumental):
-                    instrumental[i + j] = max(0, min(255, instrumental[i + j] - 15))
-    stems["instrumental_hq.wav"] = bytes(instrumental)
-    
-    # Clean Vocals - Another variation
-    clean_vocals = bytearray(original_data)
-    # Apply "vocal cleaning" - modify different pattern
-    for i in range(500, len(clean_vocals), 1500):
-        if i + 8 < len(clean_vocals):
-            for j in range(8):
-                if i + j < len(clean_vocals):
-                    clean_vocals[i + j] = max(0, min(255, clean_vocals[i + j] + 10))
-    stems["vocals_clean.wav"] = bytes(clean_vocals)
-    
-    # Karaoke Version - Third variation
-    karaoke = bytearray(original_data)
-    # Apply "karaoke effect" - different modification pattern
-    for i in range(250, len(karaoke), 2000):
-        if i + 12 < len(karaoke):
-            for j in range(12):
-                if i + j < len(karaoke):
-                    karaoke[i + j] = max(0, min(255, karaoke[i + j] ^ 3))
-    stems["karaoke_version.wav"] = bytes(karaoke)
-    
-    return True, stems, "🎉 Professional separation completed!"
+    status = job_status(st.session_state.job_id)
+    st.progress(status.progress)
+    st.text(status.message)
+    
+    return status
 
-def create_zip_package(stem_files, original_name):
-    """Create ZIP with all stems"""
-    zip_buffer = BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        # Add all stems
-        for filename, file_data in stem_files.items():
-            zip_file.writestr(filename, file_data)
-        
-        # Add info file
-        info_text = f"""🎵 DISBAND - Professional Stems
-Created by @jeysshon
+def show_previews(job_id):
+    """
+    Players for the first seconds of every stem while the job runs
 
-Original: {original_name}
-Quality: Professional
-Stems: {len(stem_files)}
-Date: {time.strftime('%Y-%m-%d %H:%M')}
+    Previews are short WAVs the worker publishes before separating the
+    whole track, so the result can be checked long before it is done.
+    """
+    previews = job_previews(job_id)
+    if not previews:
+        return
+    
+    st.markdown(f"### 🎧 Preview: first {PREVIEW_SECONDS:g} seconds")
+    link = download_link()
+    columns = st.columns(len(previews))
+    for column, (filename, path) in zip(columns, previews.items()):
+        with column:
+            st.caption(STEM_LABELS.get(os.path.splitext(filename)[0], filename))
+            st.audio(link(path, filename) if link else preview_audio(job_id, path), format="audio/wav")
 
-Files:
-- vocals_hq.wav (Vocal isolation)
-- instrumental_hq.wav (Clean backing)  
-- vocals_clean.wav (Processed vocals)
-- karaoke_version.wav (Singalong ready)
+def preview_audio(job_id, path):
+    """
+    Bytes of a preview, read again only when the worker rewrites it
 
-Thank you for using DISBAND!
-@jeysshon
-"""
-        zip_file.writestr("DISBAND_Info.txt", info_text.encode('utf-8'))
-    
-    zip_buffer.seek(0)
-    return zip_buffer.getvalue()
+    The page reruns every half second while a job runs, so the loaded
+    previews are kept in session state by job and modification time.
+    """
+    key = (job_id, os.stat(path).st_mtime_ns)
+    cached = st.session_state.previews.get(path)
+    if cached is None or cached[0] != key:
+        cached = (key, load_result(path))
+        st.session_state.previews[path] = cached
+    return cached[1]
+
+def show_overview(path):
+    """
+    Waveform and spectrogram of a stem, drawn from its saved analysis
+
+    The analysis is a few kilobytes, so reruns never read the stem itself.
+    """
+    overview = read_analysis(path)
+    if overview is None:
+        return
+    
+    st.image(waveform_image(overview.peaks), width="stretch")
+    st.image(spectrogram_image(overview.spectrogram), width="stretch")
+    if overview.clipped:
+        st.caption(f"⚠️ Clipped: {overview.clipped:,} samples")
+    elif overview.peak < 0.001:
+        st.caption("🔇 Nearly silent")
+    else:
+        st.caption(f"Peak {20 * math.log10(overview.peak):.1f} dBFS")
+
+def download_link():
+    """
+    ``link(path, filename)`` giving a result's URL on the download server
+
+    None when the server is off, and results go through the page instead.
+    """
+    server = get_download_server()
+    if server is None:
+        return None
+    return partial(server.url_for, base_url=base_url(st.context.headers.get("Host")))
+
+def get_zip_package(original_name, quality):
+    """
+    Path of the current job's ZIP package, built at most once per separation
+
+    Reruns reuse the path kept in session state; the first build (or reuse
+    of a cached package) is timed and logged.
+    """
+    package = st.session_state.package
+    if package and package["job_id"] == st.session_state.job_id:
+        return package["path"]
+    
+    started = time.perf_counter()
+    zip_path, built = build_package(
+        st.session_state.job_id, st.session_state.stem_files, original_name, quality
+    )
+    source = "built" if built else "reused"
+    seconds = time.perf_counter() - started
+    logger.info("ZIP package for job %s %s in %.3fs", st.session_state.job_id, source, seconds)
+    
+    st.session_state.package = {
+        "job_id": st.session_state.job_id,
+        "path": zip_path,
+        "source": source,
+        "seconds": seconds,
+    }
+    return zip_path
+
+def discard_results():
+    """Cancel or delete the previous separation job"""
+    if st.session_state.job_lease:
+        st.session_state.job_lease.release()
+    st.session_state.job_lease = None
+    st.session_state.job_id = None
+    st.session_state.stem_files = {}
+    st.session_state.job_metrics = None
+    st.session_state.package = None
+    st.session_state.previews = {}
 
 def main():
     """Main DISBAND application"""
+    # Page config
+    st.set_page_config(
+        page_title="🎵 Disband - Professional AI Stem Separator",
+        page_icon="🎵",
+        layout="wide",
+        initial_sidebar_state="collapsed"
+    )
     load_beautiful_css()
     
     # Session state
@@ -347,8 +416,22 @@ def main():
         st.session_state.stems_ready = False
     if 'stem_files' not in st.session_state:
         st.session_state.stem_files = {}
+    if 'job_id' not in st.session_state:
+        st.session_state.job_id = None
+    if 'job_lease' not in st.session_state:
+        # Deletes the job's files once this session is gone
+        st.session_state.job_lease = None
+    if 'package' not in st.session_state:
+        st.session_state.package = None
+    if 'previews' not in st.session_state:
+        # Preview bytes loaded for st.audio, by path
+        st.session_state.previews = {}
+    if 'job_profile' not in st.session_state:
+        st.session_state.job_profile = None
     if 'processed_count' not in st.session_state:
         st.session_state.processed_count = 0
+    if 'job_metrics' not in st.session_state:
+        st.session_state.job_metrics = None
     
     # Hero Section
     st.markdown("""
@@ -364,7 +447,8 @@ def main():
     with col1:
         st.metric("🎯 Accuracy", "99.2%")
     with col2:
-        st.metric("⚡ Speed", "3 min avg")
+        average = get_registry().average_job_seconds()
+        st.metric("⚡ Speed", f"{format_duration(average)} avg" if average is not None else "—")
     with col3:
         st.metric("🎵 Processed", f"{st.session_state.processed_count + 1247}")
     with col4:
@@ -385,15 +469,18 @@ def main():
         </div>
         """, unsafe_allow_html=True)
         
+        # Without ffmpeg only PCM WAV can be separated
+        decodes = can_decode()
         uploaded_file = st.file_uploader(
             "Drop your audio file here",
-            type=['mp3', 'wav', 'flac', 'm4a', 'aac'],
-            help="All major audio formats supported",
+            type=list(AUDIO_EXTENSIONS) if decodes else ["wav"],
+            help="All major audio formats supported" if decodes
+            else "PCM WAV only (other formats need ffmpeg on the server)",
             label_visibility="collapsed"
         )
         
         if uploaded_file:
-            file_size_mb = len(uploaded_file.getbuffer()) / (1024 * 1024)
+            file_size_mb = uploaded_file.size / (1024 * 1024)
             st.markdown(f"""
             <div class="file-info">
                 <h3>🎼 {uploaded_file.name}</h3>
@@ -412,14 +499,20 @@ def main():
             with col_set1:
                 quality = st.selectbox(
                     "🎯 Quality",
-                    ["🏆 Maximum (Recommended)", "⚡ Balanced", "🚀 Fast"],
+                    list(QUALITY_PROFILES),
                     help="Higher quality = better results"
                 )
             with col_set2:
+                # Without ffmpeg MP3 stems would quietly come out as WAV
+                formats = [
+                    label for label, name in OUTPUT_FORMATS.items()
+                    if name != "mp3" or mp3_available()
+                ]
                 format_type = st.selectbox(
                     "🎧 Output", 
-                    ["📀 WAV (Best)", "🎵 MP3 320k", "💎 FLAC"],
-                    help="Audio format preference"
+                    formats,
+                    help="Audio format preference" if len(formats) == len(OUTPUT_FORMATS)
+                    else "Audio format preference (MP3 needs ffmpeg on the server)"
                 )
             
             # Process button
@@ -427,7 +520,7 @@ def main():
                 if st.button("🚀 START SEPARATION", use_container_width=True):
                     st.session_state.processing = True
                     st.session_state.stems_ready = False
-                    st.session_state.stem_files = {}
+                    discard_results()
                     st.rerun()
             elif st.session_state.processing:
                 st.button("⚡ PROCESSING...", disabled=True, use_container_width=True)
@@ -437,7 +530,7 @@ def main():
                     if st.button("🔄 NEW FILE", use_container_width=True):
                         st.session_state.processing = False
                         st.session_state.stems_ready = False
-                        st.session_state.stem_files = {}
+                        discard_results()
                         st.rerun()
                 with col_btn2:
                     if st.button("⬇️ DOWNLOAD", use_container_width=True):
@@ -477,16 +570,34 @@ def main():
         </div>
         """, unsafe_allow_html=True)
         
-        success, stem_files, message = separate_audio_real(uploaded_file)
+        status = separate_audio_real(
+            uploaded_file, (quality,), QUALITY_PROFILES[quality], OUTPUT_FORMATS[format_type]
+        )
         
-        if success:
-            st.session_state.stem_files = stem_files
+        if status.state == "done":
+            st.session_state.stem_files = status.stems
+            st.session_state.job_metrics = status.metrics
+            st.session_state.previews = {}
             st.session_state.stems_ready = True
             st.session_state.processing = False
             st.session_state.processed_count += 1
             st.rerun()
+        elif status.state in ("failed", "missing", "rejected"):
+            st.error(status.message)
+            st.session_state.processing = False
+            discard_results()
+        else:
+            show_previews(st.session_state.job_id)
+            # Check on the worker again without holding the script thread
+            time.sleep(POLL_INTERVAL)
+            st.rerun()
     
     # Results
+    if st.session_state.stems_ready and not touch_job(st.session_state.job_id):
+        st.warning("⌛ These results have expired, please separate the file again")
+        st.session_state.stems_ready = False
+        discard_results()
+    
     if st.session_state.stems_ready and st.session_state.stem_files:
         st.markdown("""
         <div class="results-container">
@@ -503,15 +614,23 @@ def main():
             st.markdown("### 🎵 Your Professional Stems")
             
             stem_info = {
-                "vocals_hq.wav": ("🎤", "High-Quality Vocals", "Clean vocal isolation"),
-                "instrumental_hq.wav": ("🎹", "Premium Instrumental", "Perfect backing track"),
-                "vocals_clean.wav": ("✨", "Processed Vocals", "Noise-reduced vocals"),
-                "karaoke_version.wav": ("🎵", "Karaoke Ready", "Sing-along version")
+                "vocals_hq": ("🎤", "High-Quality Vocals", "Clean vocal isolation"),
+                "instrumental_hq": ("🎹", "Premium Instrumental", "Perfect backing track"),
+                "vocals_clean": ("✨", "Processed Vocals", "Noise-reduced vocals"),
+                "karaoke_version": ("🎵", "Karaoke Ready", "Sing-along version"),
+                "bass": ("🎸", "Bass", "Low end and bass line"),
+                "drums": ("🥁", "Drums", "Kick, snare and cymbals")
+            }
+            
+            overviews = {
+                os.path.splitext(name)[0]: path
+                for name, path in job_analyses(st.session_state.job_id).items()
             }
             
             for filename in st.session_state.stem_files.keys():
-                if filename in stem_info:
-                    icon, title, desc = stem_info[filename]
+                stem = os.path.splitext(filename)[0]
+                if stem in stem_info:
+                    icon, title, desc = stem_info[stem]
                     st.markdown(f"""
                     <div class="stem-card">
                         <span class="stem-icon">{icon}</span>
@@ -519,25 +638,27 @@ def main():
                         <span style="opacity: 0.8; font-size: 0.9rem;">{desc}</span>
                     </div>
                     """, unsafe_allow_html=True)
+                    if stem in overviews:
+                        show_overview(overviews[stem])
         
         with col_results2:
             st.markdown("### 💎 Downloads")
             
-            # Individual downloads
-            download_labels = {
-                "vocals_hq.wav": "🎤 Vocals HQ",
-                "instrumental_hq.wav": "🎹 Instrumental", 
-                "vocals_clean.wav": "✨ Clean Vocals",
-                "karaoke_version.wav": "🎵 Karaoke"
-            }
+            # Links to the download server keep file contents off the page
+            link = download_link()
             
-            for filename, file_data in st.session_state.stem_files.items():
-                if filename in download_labels:
+            # Individual downloads
+            for filename, file_path in st.session_state.stem_files.items():
+                stem = os.path.splitext(filename)[0]
+                if stem in STEM_LABELS and link:
+                    st.link_button(f"⬇️ {STEM_LABELS[stem]}", link(file_path, filename))
+                elif stem in STEM_LABELS:
+                    # Read from disk only when the button is clicked
                     st.download_button(
-                        label=f"⬇️ {download_labels[filename]}",
-                        data=file_data,
+                        label=f"⬇️ {STEM_LABELS[stem]}",
+                        data=partial(load_result, file_path),
                         file_name=filename,
-                        mime="audio/wav",
+                        mime=mime_for(filename),
                         key=f"dl_{filename}"
                     )
             
@@ -548,23 +669,36 @@ def main():
             # Get filename without extension
             filename_base = uploaded_file.name.rsplit('.', 1)[0] if '.' in uploaded_file.name else uploaded_file.name
             
-            zip_data = create_zip_package(st.session_state.stem_files, uploaded_file.name)
-            st.download_button(
-                label="📦 DOWNLOAD ALL",
-                data=zip_data,
-                file_name=f"DISBAND_{filename_base}_Stems.zip",
-                mime="application/zip",
-                help="All stems + info file"
-            )
+            profile = get_profile(st.session_state.job_profile)
+            zip_path = get_zip_package(uploaded_file.name, profile.label)
+            zip_name = f"DISBAND_{filename_base}_Stems.zip"
+            if link:
+                st.link_button("📦 DOWNLOAD ALL", link(zip_path, zip_name), help="All stems + info file")
+            else:
+                st.download_button(
+                    label="📦 DOWNLOAD ALL",
+                    data=partial(load_result, zip_path),
+                    file_name=zip_name,
+                    mime="application/zip",
+                    help="All stems + info file"
+                )
             
             # Stats
+            metrics = st.session_state.job_metrics
+            measured = ""
+            if metrics:
+                # Cache hits did not run a worker, so they have no peak memory
+                peak = metrics['peak_rss_bytes']
+                peak_line = f"• Peak memory: {peak / 1e6:.0f} MB<br>" if peak is not None else ""
+                measured = f"""
+                • Time: {format_duration(metrics['wall_seconds'])} (job process CPU {format_duration(metrics['cpu_seconds'])})<br>
+                • Data: {metrics['bytes_in'] / 1e6:.1f} MB in, {metrics['bytes_out'] / 1e6:.1f} MB out<br>
+                {peak_line}• Cache: {metrics['cache']}"""
             st.markdown(f"""
             <div style="background: rgba(255,255,255,0.1); padding: 1rem; border-radius: 10px; margin-top: 1rem;">
                 <strong>📊 Stats:</strong><br>
-                • Quality: Professional<br>
-                • Stems: {len(st.session_state.stem_files)}<br>
-                • Time: 3.2 min<br>
-                • Accuracy: 99.2%
+                • Quality: {profile.label}<br>
+                • Stems: {len(st.session_state.stem_files)}<br>{measured}
             </div>
             """, unsafe_allow_html=True)
     
@@ -595,4 +729,5 @@ def main():
     """, unsafe_allow_html=True)
 
 if __name__ == "__main__":
+    import streamlit as st
     main()
@@ -0,0 +1,84 @@
+"""
+Import-time benchmark
+
+Every process pool worker is spawned fresh and re-imports the app's main
+module before it can run a job, and every batch run or script starts cold.
+This measures, in a new interpreter per sample, how long each entry point
+takes to import and how much memory it leaves resident:
+
+    python benchmarks/import_time.py --repeat 7 --json import_time.json
+
+"app.py (worker)" runs app.py the way a spawned worker does, under the name
+``__mp_main__``; "streamlit" is what that used to cost on top of the core.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> statement timed in a fresh interpreter
+TARGETS = {
+    "python": "pass",
+    "disband core": "import disband.cli, disband.jobs",
+    "app.py (worker)": f"import runpy; runpy.run_path({os.path.join(ROOT, 'app.py')!r}, run_name='__mp_main__')",
+    "streamlit": "import streamlit",
+}
+
+# Runs in the child: time the statement, then report peak RSS in KiB
+PROBE = """
+import resource, sys, time
+started = time.perf_counter()
+exec(sys.argv[1])
+seconds = time.perf_counter() - started
+print(seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "streamlit" in sys.modules)
+"""
+
+
+def measure(statement):
+    """``(seconds, peak RSS in MiB, streamlit imported)`` of one cold import"""
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE, statement],
+        cwd=ROOT, check=True, capture_output=True, text=True,
+        env={**os.environ, "PYTHONPATH": ROOT},
+    ).stdout.split()
+    return float(output[0]), int(output[1]) / 1024, output[2] == "True"
+
+
+def run(repeat):
+    """Median import time and peak RSS of every target"""
+    results = {}
+    for name, statement in TARGETS.items():
+        samples = [measure(statement) for _ in range(repeat)]
+        results[name] = {
+            "seconds": statistics.median(sample[0] for sample in samples),
+            "peak_rss_mb": statistics.median(sample[1] for sample in samples),
+            "imports_streamlit": samples[0][2],
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="cold imports per target")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat)
+    print(f"{'target':<18}{'import ms':>11}{'peak RSS MB':>13}  streamlit")
+    for name, result in results.items():
+        print(
+            f"{name:<18}{result['seconds'] * 1000:>11.1f}{result['peak_rss_mb']:>13.1f}"
+            f"  {'yes' if result['imports_streamlit'] else 'no'}"
+        )
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,501 @@
+"""
+Concurrent sessions load test
+
+Starts the app with ``streamlit run`` (or targets one already running with
+``--url``) and drives it from many simulated browser tabs at once. Each
+session speaks Streamlit's own protocol over its websocket: it uploads a
+synthetic 16-bit stereo WAV through the upload endpoint, picks the quality
+and output, clicks START SEPARATION, waits for the download buttons, then
+clicks NEW FILE and does it again:
+
+    python benchmarks/loadtest.py --sessions 8 --rounds 2 --sizes 1,10 --json load.json
+
+Reported:
+- throughput: separations finished per minute and upload MB per second
+- latency from the START click to the results, p50/p95/p99, and the same
+  for the first stem preview
+- outcomes: done, rejected by the queue, or failed
+- RSS of the server process and of its job workers, sampled over time
+
+Every upload gets its own content so nothing is served from the result
+cache, unless ``--same-file`` asks for exactly that. RSS is read from
+/proc, so it is only sampled on Linux. Sessions talk to the server like a
+browser does, so nothing runs inside this process but the clients; with
+``--url`` the server's pid is needed for RSS (``--server-pid``). With
+``--max-p95`` the run fails when the p95 latency is above it, and any
+failed separation fails it too.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+from streamlit.proto.Alert_pb2 import Alert  # noqa: E402
+from streamlit.proto.BackMsg_pb2 import BackMsg  # noqa: E402
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg  # noqa: E402
+from streamlit.proto.WidgetStates_pb2 import WidgetState  # noqa: E402
+from websockets.sync.client import connect  # noqa: E402
+
+from app import OUTPUT_FORMATS, QUALITY_PROFILES  # noqa: E402
+from throughput import MB, git_revision, make_wav  # noqa: E402
+
+DEFAULT_SIZES = "1,10"
+START_LABEL = "🚀 START SEPARATION"
+NEW_FILE_LABEL = "🔄 NEW FILE"
+QUALITY_LABEL = "🎯 Quality"
+OUTPUT_LABEL = "🎧 Output"
+# Icon of the app's message when the job queue turns an upload away
+REJECTED_ICON = "🚦"
+# Seconds between RSS samples
+SAMPLE_INTERVAL = 1.0
+
+
+def find(elements, kind, label=None):
+    """First element of ``kind`` (and ``label``) in a script run, or None"""
+    for element in elements:
+        if element.WhichOneof("type") == kind:
+            widget = getattr(element, kind)
+            if label is None or widget.label == label:
+                return widget
+    return None
+
+
+class Session:
+    """One browser tab: a websocket to the app and the widget values it has set"""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.socket = connect(
+            "ws" + self.base_url[len("http"):] + "/_stcore/stream",
+            subprotocols=["streamlit"], max_size=None, open_timeout=timeout,
+        )
+        self.session_id = None
+        # Widget values the browser would send with every rerun
+        self.widgets = {}
+        # Elements of the script run in progress, or of the last one
+        self.elements = []
+
+    def __enter__(self):
+        self.socket.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.socket.__exit__(*exc_info)
+
+    def receive(self, deadline):
+        """Next message from the server; raises TimeoutError past ``deadline``"""
+        message = ForwardMsg()
+        message.ParseFromString(self.socket.recv(timeout=max(0.0, deadline - time.monotonic())))
+        kind = message.WhichOneof("type")
+        if kind == "new_session":
+            self.elements = []
+            if message.new_session.initialize.session_id:
+                self.session_id = message.new_session.initialize.session_id
+        elif kind == "delta" and message.delta.WhichOneof("type") == "new_element":
+            self.elements.append(message.delta.new_element)
+        return message
+
+    def rerun(self, *clicked):
+        """Rerun the script with the widget values set so far and a click on each of ``clicked``"""
+        message = BackMsg()
+        widgets = message.rerun_script.widget_states.widgets
+        widgets.extend(self.widgets.values())
+        for widget_id in clicked:
+            widgets.add(id=widget_id, trigger_value=True)
+        self.socket.send(message.SerializeToString())
+
+    def wait(self, check, on_message=None):
+        """
+        Read messages until ``check(elements)`` is true at the end of a script run
+
+        Returns that value. ``on_message(elements)`` sees every message on
+        the way, for timing what appears while the script reruns itself.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            message = self.receive(deadline)
+            if on_message:
+                on_message(self.elements)
+            if message.WhichOneof("type") == "script_finished":
+                result = check(self.elements)
+                if result:
+                    return result
+
+    def upload(self, name, data):
+        """Upload ``data`` as the file uploader's file, as the browser does"""
+        request = BackMsg()
+        request.file_urls_request.request_id = uuid.uuid4().hex
+        request.file_urls_request.file_names.append(name)
+        request.file_urls_request.session_id = self.session_id
+        self.socket.send(request.SerializeToString())
+        deadline = time.monotonic() + self.timeout
+        while True:
+            message = self.receive(deadline)
+            if (
+                message.WhichOneof("type") == "file_urls_response"
+                and message.file_urls_response.response_id == request.file_urls_request.request_id
+            ):
+                break
+        if message.file_urls_response.error_msg:
+            raise RuntimeError(message.file_urls_response.error_msg)
+        urls = message.file_urls_response.file_urls[0]
+
+        boundary = uuid.uuid4().hex
+        body = b"".join([
+            f"--{boundary}\r\n".encode(),
+            f'Content-Disposition: form-data; name="file"; filename="{name}"\r\n'.encode(),
+            b"Content-Type: audio/wav\r\n\r\n",
+            data,
+            f"\r\n--{boundary}--\r\n".encode(),
+        ])
+        url = urls.upload_url if "://" in urls.upload_url else self.base_url + urls.upload_url
+        put = urllib.request.Request(
+            url, data=body, method="PUT",
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        )
+        urllib.request.urlopen(put, timeout=self.timeout).close()
+
+        uploader = find(self.elements, "file_uploader")
+        state = WidgetState(id=uploader.id)
+        state.file_uploader_state_value.uploaded_file_info.add(
+            name=name, size=len(data), file_id=urls.file_id, file_urls=urls,
+        )
+        self.widgets[uploader.id] = state
+
+    def select(self, label, option):
+        """Choose ``option`` in the selectbox labelled ``label``"""
+        selectbox = find(self.elements, "selectbox", label)
+        self.widgets[selectbox.id] = WidgetState(id=selectbox.id, string_value=option)
+
+
+def outcome_of(elements):
+    """``(outcome, message)`` once a script run shows results or an error, else None"""
+    if find(elements, "download_button") or find(elements, "link_button"):
+        return "done", ""
+    for element in elements:
+        if element.WhichOneof("type") == "alert" and element.alert.format == Alert.ERROR:
+            alert = element.alert
+            # Streamlit moves a leading emoji out of the message into the icon
+            rejected = alert.icon == REJECTED_ICON or alert.body.startswith(REJECTED_ICON)
+            return ("rejected" if rejected else "failed"), alert.body
+    return None
+
+
+def separate(session, name, data, quality, output):
+    """Upload, separate and reset once in ``session``; returns its record"""
+    if not session.elements:
+        session.rerun()
+        session.wait(lambda elements: find(elements, "file_uploader"))
+    started = time.perf_counter()
+    session.upload(name, data)
+    session.rerun()
+    start = session.wait(lambda elements: find(elements, "button", START_LABEL))
+    upload_seconds = time.perf_counter() - started
+    session.select(QUALITY_LABEL, quality)
+    session.select(OUTPUT_LABEL, output)
+
+    preview = []
+
+    def on_message(elements):
+        if not preview and find(elements, "audio"):
+            preview.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    session.rerun(start.id)
+    outcome, message = session.wait(outcome_of, on_message)
+    seconds = time.perf_counter() - started
+
+    new_file = find(session.elements, "button", NEW_FILE_LABEL)
+    if new_file is not None:
+        session.rerun(new_file.id)
+        session.wait(lambda elements: find(elements, "button", START_LABEL))
+    return {
+        "outcome": outcome,
+        "message": message,
+        "seconds": seconds,
+        "preview_seconds": preview[0] if preview else None,
+        "upload_seconds": upload_seconds,
+    }
+
+
+def process_tree(pid):
+    """``pid`` and every process below it, from /proc"""
+    pids = [pid]
+    for parent in pids:
+        try:
+            tasks = os.listdir(f"/proc/{parent}/task")
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                with open(f"/proc/{parent}/task/{task}/children") as children:
+                    pids.extend(int(child) for child in children.read().split())
+            except OSError:
+                pass
+    return pids
+
+
+def rss_bytes(pid):
+    """Resident memory of one process, 0 once it is gone"""
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def sample_rss(pid, samples, stop, started):
+    """Append ``(seconds, server MB, workers MB)`` to ``samples`` until ``stop`` is set"""
+    while not stop.wait(SAMPLE_INTERVAL):
+        server, *workers = process_tree(pid)
+        samples.append((
+            time.perf_counter() - started, rss_bytes(server) / MB,
+            sum(rss_bytes(worker) for worker in workers) / MB,
+        ))
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_server(log_path, timeout=60):
+    """Start the app on a free port; returns the process and its base URL"""
+    port = free_port()
+    with open(log_path, "wb") as log:
+        process = subprocess.Popen(
+            [
+                sys.executable, "-m", "streamlit", "run", os.path.join(ROOT, "app.py"),
+                "--server.headless", "true", "--server.port", str(port),
+                "--server.enableXsrfProtection", "false", "--browser.gatherUsageStats", "false",
+            ],
+            cwd=ROOT, stdout=log, stderr=subprocess.STDOUT,
+        )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            urllib.request.urlopen(base_url + "/_stcore/health", timeout=1).close()
+            return process, base_url
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"The app did not start; see {log_path}")
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile, or None without values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def run(base_url, server_pid, sessions, rounds, quality, output, timeout, ramp, inputs):
+    """Drive ``sessions`` concurrent sessions; returns the job records, RSS samples and wall time"""
+    records = []
+    lock = threading.Lock()
+
+    def session_loop(index):
+        time.sleep(ramp * index / sessions)
+        round_index = 0
+        while round_index < rounds:
+            size_mb, path = inputs[index][round_index]
+            record = {"session": index, "round": round_index, "size_mb": size_mb}
+            # A failed round leaves the page in an unknown state: the next one opens a new tab
+            try:
+                with Session(base_url, timeout) as session:
+                    while True:
+                        with open(path, "rb") as upload:
+                            data = upload.read()
+                        record.update(separate(session, os.path.basename(path), data, quality, output))
+                        finish(record)
+                        round_index += 1
+                        if round_index == rounds:
+                            break
+                        size_mb, path = inputs[index][round_index]
+                        record = {"session": index, "round": round_index, "size_mb": size_mb}
+            except Exception as error:
+                record.update(outcome="failed", message=repr(error), seconds=None)
+                finish(record)
+                round_index += 1
+
+    def finish(record):
+        with lock:
+            records.append(record)
+        print(
+            f"  session {record['session']:>3} round {record['round']} {record['size_mb']:>4} MB  {record['outcome']:<8}"
+            + (f"{record['seconds']:>8.2f} s" if record["seconds"] is not None else "")
+            + (f"  {record['message']}" if record["outcome"] == "failed" else "")
+        )
+
+    samples = []
+    stop = threading.Event()
+    started = time.perf_counter()
+    sampler = None
+    if server_pid and os.path.isdir("/proc"):
+        sampler = threading.Thread(target=sample_rss, args=(server_pid, samples, stop, started), daemon=True)
+        sampler.start()
+    threads = [threading.Thread(target=session_loop, args=(index,)) for index in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    stop.set()
+    if sampler is not None:
+        sampler.join()
+    return records, samples, wall
+
+
+def summarize(records, samples, wall):
+    """Throughput, latency percentiles and peak RSS of a run"""
+    done = [record for record in records if record["outcome"] == "done"]
+    latencies = [record["seconds"] for record in done]
+    previews = [record["preview_seconds"] for record in done if record["preview_seconds"] is not None]
+    summary = {
+        "wall_seconds": wall,
+        "jobs": len(records),
+        "outcomes": {
+            outcome: sum(record["outcome"] == outcome for record in records)
+            for outcome in ("done", "rejected", "failed")
+        },
+        "jobs_per_minute": len(done) / wall * 60 if wall else None,
+        "mb_s": sum(record["size_mb"] for record in done) / wall if wall else None,
+        "peak_server_rss_mb": max((sample[1] for sample in samples), default=None),
+        "peak_workers_rss_mb": max((sample[2] for sample in samples), default=None),
+    }
+    for name, values in (("latency", latencies), ("preview", previews)):
+        for label, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            summary[f"{name}_{label}"] = percentile(values, fraction)
+    return summary
+
+
+def print_report(summary, samples):
+    def seconds(value):
+        return f"{value:.2f} s" if value is not None else "-"
+
+    outcomes = summary["outcomes"]
+    print(
+        f"\n{outcomes['done']}/{summary['jobs']} done, {outcomes['rejected']} rejected, "
+        f"{outcomes['failed']} failed in {summary['wall_seconds']:.1f} s"
+    )
+    print(f"throughput {summary['jobs_per_minute']:.1f} jobs/min, {summary['mb_s']:.2f} MB/s")
+    for name in ("latency", "preview"):
+        print(
+            f"{name:<10} p50 {seconds(summary[f'{name}_p50'])}  p95 {seconds(summary[f'{name}_p95'])}"
+            f"  p99 {seconds(summary[f'{name}_p99'])}"
+        )
+    if samples:
+        print(f"\n{'t':>8}{'server RSS':>14}{'workers RSS':>14}")
+        step = max(1, len(samples) // 20)
+        for at, server, workers in samples[::step]:
+            print(f"{at:>7.0f}s{server:>11.0f} MB{workers:>11.0f} MB")
+        print(
+            f"peak server {summary['peak_server_rss_mb']:.0f} MB, "
+            f"workers {summary['peak_workers_rss_mb']:.0f} MB"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent sessions")
+    parser.add_argument("--rounds", type=int, default=1, help="separations per session, one after another")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="upload sizes in MB, comma separated, cycled over sessions")
+    parser.add_argument("--quality", default="maximum", choices=sorted(set(QUALITY_PROFILES.values())))
+    parser.add_argument("--format", default="wav", choices=sorted(set(OUTPUT_FORMATS.values())))
+    parser.add_argument("--ramp", type=float, default=0.0, help="seconds over which sessions start")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds to wait for any one step")
+    parser.add_argument("--same-file", action="store_true", help="upload the same file everywhere, to load the cache")
+    parser.add_argument("--url", help="test this running app instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="pid of the --url server, for RSS")
+    parser.add_argument("--data-dir", help="keep generated inputs here between runs")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--max-p95", type=float, help="fail if the p95 latency is above this many seconds")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    quality = next(label for label, name in QUALITY_PROFILES.items() if name == args.quality)
+    output = next(label for label, name in OUTPUT_FORMATS.items() if name == args.format)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="disband_load_")
+    os.makedirs(data_dir, exist_ok=True)
+
+    # Inputs are written before the clock starts; each upload is unique unless --same-file
+    inputs = []
+    for index in range(args.sessions):
+        size_mb = sizes[index % len(sizes)]
+        inputs.append([])
+        for round_index in range(args.rounds):
+            seed = 0 if args.same_file else index * args.rounds + round_index + 1
+            path = os.path.join(data_dir, f"load_{size_mb}mb_{seed}.wav")
+            if not os.path.exists(path):
+                make_wav(path, size_mb, seed)
+            inputs[index].append((size_mb, path))
+
+    process = None
+    base_url, server_pid = args.url, args.server_pid
+    if base_url is None:
+        process, base_url = start_server(os.path.join(data_dir, "server.log"))
+        server_pid = process.pid
+    print(f"{args.sessions} sessions x {args.rounds} rounds against {base_url}")
+    try:
+        records, samples, wall = run(
+            base_url, server_pid, args.sessions, args.rounds, quality, output,
+            args.timeout, args.ramp, inputs,
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    summary = summarize(records, samples, wall)
+    print_report(summary, samples)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as results:
+            json.dump({
+                "revision": git_revision(),
+                "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "settings": {
+                    "sessions": args.sessions, "rounds": args.rounds, "sizes": sizes,
+                    "quality": args.quality, "format": args.format, "same_file": args.same_file,
+                },
+                "summary": summary,
+                "rss": [{"seconds": at, "server_mb": server, "workers_mb": workers} for at, server, workers in samples],
+                "jobs": sorted(records, key=lambda record: (record["session"], record["round"])),
+            }, results, indent=2)
+
+    failed = summary["outcomes"]["failed"]
+    if failed:
+        print(f"❌ {failed} separations failed")
+    slow = args.max_p95 is not None and (summary["latency_p95"] or math.inf) > args.max_p95
+    if slow:
+        print(f"❌ p95 latency above {args.max_p95:g} s")
+    if failed or slow:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Separation and packaging throughput benchmark
+
+Generates synthetic 16-bit stereo 44.1 kHz WAV inputs of each size, then
+runs every stage of a separation directly on the processing core (no UI,
+no polling sleeps) and records its throughput, peak RSS and Python-level
+allocations:
+
+    python benchmarks/throughput.py --sizes 1,10,50,200 --json results.json
+
+Stages:
+- ``submit``: hash an in-memory upload and write it to a job folder
+- ``decode``: read the samples as float blocks, as separation reads them
+- ``stem:<name>``: read, separate, analyse and write that one stem
+- ``separate``: all stems and their analyses in one pass, as a job does
+- ``encode:flac``: FLAC-encode the vocal stem
+- ``zip``: package all stems
+- ``job``: a whole job from the input file: separate, keep WAV, package
+
+Each measurement runs in a fresh process, so peak RSS belongs to that
+stage alone. Timings are the median of ``--repeat`` runs; allocations come
+from one extra run under tracemalloc, which slows Python down. Everything
+runs offline. Compare two commits by diffing their JSON files.
+
+``full_size_allocs`` is not a count of allocations: it is the tracemalloc
+peak in whole multiples of the input size, so 0 means the stage's buffers
+never added up to the input. With ``--max-full-size-allocs`` the run fails
+if a stage that handles the upload itself exceeds it. Inputs smaller than
+a few dozen blocks do not show that: a block's own buffers are about 90
+times its input. tests/test_memory.py asserts the same bound for every
+profile on an input well past that.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+
+from disband.cache import cache_key  # noqa: E402
+from disband.encoders import encode_flac  # noqa: E402
+from disband.jobs import separate_file  # noqa: E402
+from disband.packaging import create_zip_package  # noqa: E402
+from disband.pipeline import open_track, separate_to_directory  # noqa: E402
+from disband.profiles import DEFAULT_PROFILE, get_profile  # noqa: E402
+from disband.stems import STEM_NAMES  # noqa: E402
+
+DEFAULT_SIZES = "1,10,50,200"
+SAMPLE_RATE = 44100
+CHANNELS = 2
+MB = 1024 * 1024
+STAGES = ["submit", "decode", *(f"stem:{name}" for name in STEM_NAMES), "separate", "encode:flac", "zip", "job"]
+# Stages that handle the upload itself, held to --max-full-size-allocs
+UPLOAD_STAGES = {"submit", "decode", *(f"stem:{name}" for name in STEM_NAMES), "separate", "job"}
+
+
+def make_wav(path, size_mb, seed=0):
+    """Write a WAV of about ``size_mb`` MiB: a few tones plus noise"""
+    rng = np.random.default_rng(seed)
+    frames = size_mb * MB // (CHANNELS * 2)
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(CHANNELS)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        for start in range(0, frames, SAMPLE_RATE):
+            t = np.arange(start, min(start + SAMPLE_RATE, frames)) / SAMPLE_RATE
+            tone = 6000 * np.sin(2 * np.pi * 220 * t) + 3000 * np.sin(2 * np.pi * 1760 * t)
+            left = tone + rng.normal(0, 500, len(t))
+            right = 0.8 * tone + rng.normal(0, 500, len(t))
+            wav.writeframes(np.stack([left, right], axis=1).astype("<i2").tobytes())
+
+
+def load_upload(input_path):
+    """The input as Streamlit holds an upload: one in-memory buffer"""
+    with open(input_path, "rb") as source:
+        return bytearray(source.read())
+
+
+def run_stage(stage, input_path, stems_dir, work_dir, upload=None):
+    """Run one stage once; returns the number of bytes it processed"""
+    profile = get_profile(DEFAULT_PROFILE)
+    total_size = os.path.getsize(input_path)
+    if stage == "submit":
+        # What the app does with getbuffer(): hash and write a view of it
+        data = memoryview(upload)
+        cache_key(data, ())
+        with open(os.path.join(work_dir, "input"), "wb") as input_file:
+            input_file.write(data)
+        return total_size
+    if stage == "decode":
+        with open(input_path, "rb") as source:
+            track = open_track(source, total_size)
+            block = profile.window_size // track.frame_size
+            for first in range(0, track.frames, block):
+                track.read(first, min(first + block, track.frames))
+        return total_size
+    if stage.startswith("stem:") or stage == "separate":
+        names = STEM_NAMES if stage == "separate" else [stage.split(":", 1)[1]]
+        with open(input_path, "rb") as source:
+            separate_to_directory(
+                source, total_size, work_dir, profile.window_size, None, names, analyze=True
+            )
+        return total_size
+    if stage == "encode:flac":
+        encode_flac(os.path.join(stems_dir, STEM_NAMES[0]), os.path.join(work_dir, "stem.flac"))
+        return total_size
+    if stage == "zip":
+        stems = {name: os.path.join(stems_dir, name) for name in STEM_NAMES}
+        create_zip_package(stems, os.path.basename(input_path), os.path.join(work_dir, "stems.zip"))
+        return sum(os.path.getsize(path) for path in stems.values())
+    if stage == "job":
+        separate_file(
+            input_path, work_dir, DEFAULT_PROFILE, package_path=os.path.join(work_dir, "stems.zip")
+        )
+        return total_size
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def measure_stage(stage, input_path, stems_dir, trace=False):
+    """
+    Worker entry point: one timed run of ``stage`` in this fresh process
+
+    Returns seconds, bytes processed, RSS before and peak RSS in MiB, and
+    with ``trace`` the tracemalloc peak in MiB.
+    """
+    work_dir = tempfile.mkdtemp(prefix="disband_bench_")
+    # The upload already sits in memory before a job is submitted
+    upload = load_upload(input_path) if stage == "submit" else None
+    try:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        if trace:
+            tracemalloc.start()
+        started = time.perf_counter()
+        processed = run_stage(stage, input_path, stems_dir, work_dir, upload)
+        seconds = time.perf_counter() - started
+        alloc_peak = None
+        if trace:
+            alloc_peak = tracemalloc.get_traced_memory()[1] / MB
+            tracemalloc.stop()
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return seconds, processed, rss_before, rss_peak, alloc_peak
+
+
+def in_fresh_process(*args):
+    """Run ``measure_stage`` in a new process and return its result"""
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return executor.submit(measure_stage, *args).result()
+
+
+def git_revision():
+    """Commit the benchmark ran against, if this is a git checkout"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, check=True,
+            capture_output=True, text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, stages, repeat, data_dir):
+    """Measure every stage at every size; returns a list of result rows"""
+    rows = []
+    for size_mb in sizes:
+        input_path = os.path.join(data_dir, f"synthetic_{size_mb}mb.wav")
+        if not os.path.exists(input_path):
+            make_wav(input_path, size_mb)
+        stems_dir = os.path.join(data_dir, f"stems_{size_mb}mb")
+        if not os.path.isdir(stems_dir):
+            os.makedirs(stems_dir)
+            with open(input_path, "rb") as source:
+                separate_to_directory(source, os.path.getsize(input_path), stems_dir)
+
+        for stage in stages:
+            timed = [in_fresh_process(stage, input_path, stems_dir) for _ in range(repeat)]
+            traced = in_fresh_process(stage, input_path, stems_dir, True)
+            seconds = statistics.median(sample[0] for sample in timed)
+            processed = timed[0][1]
+            input_size = os.path.getsize(input_path)
+            row = {
+                "size_mb": size_mb,
+                "stage": stage,
+                "seconds": seconds,
+                "mb_s": processed / MB / seconds if seconds else None,
+                "rss_base_mb": statistics.median(sample[2] for sample in timed),
+                "peak_rss_mb": max(sample[3] for sample in timed),
+                "alloc_peak_mb": traced[4],
+                "full_size_allocs": int(traced[4] * MB // input_size) if input_size else 0,
+            }
+            rows.append(row)
+            print(
+                f"{size_mb:>6} MB  {stage:<28}{row['mb_s']:>9.1f} MB/s"
+                f"{row['peak_rss_mb']:>9.1f} MB RSS{row['alloc_peak_mb']:>9.2f} MB alloc"
+                f"{row['full_size_allocs']:>4} full-size"
+            )
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="input sizes in MB, comma separated")
+    parser.add_argument("--stages", default=",".join(STAGES), help="stages to run, comma separated")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+    parser.add_argument("--data-dir", help="keep generated inputs here between runs")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument(
+        "--max-full-size-allocs", type=int,
+        help="fail if a stage handling the upload peaks above this many times the input size",
+    )
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    stages = args.stages.split(",")
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="disband_bench_data_")
+    os.makedirs(data_dir, exist_ok=True)
+    try:
+        rows = run(sizes, stages, args.repeat, data_dir)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump({
+                "revision": git_revision(),
+                "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "results": rows,
+            }, output, indent=2)
+
+    if args.max_full_size_allocs is not None:
+        over = [
+            row for row in rows
+            if row["stage"] in UPLOAD_STAGES and row["full_size_allocs"] > args.max_full_size_allocs
+        ]
+        for row in over:
+            print(f"❌ {row['stage']} at {row['size_mb']} MB: {row['full_size_allocs']} full-size allocations")
+        if over:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
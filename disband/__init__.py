@@ -0,0 +1,4 @@
+"""
+🎵 DISBAND - audio processing core
+Created by @jeysshon
+"""
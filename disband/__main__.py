@@ -0,0 +1,7 @@
+"""Run the command line batch separation: ``python -m disband``"""
+
+import sys
+
+from disband.cli import main
+
+sys.exit(main())
@@ -0,0 +1,191 @@
+"""
+Stem overviews
+
+While a stem is separated, each block of it passes through a StemAnalysis
+on its way to disk. The analysis keeps a min/max peak envelope of the
+samples, counts the samples that clip, and averages a few frames of the
+stem's spectrum, which the spectral engine has already computed, into
+each column of a coarse log-frequency spectrogram. Every value is filed
+under the absolute position it came from, so blocks may arrive in any
+size, an interrupted run can carry on from a saved state, and analyses of
+different parts of a track add up to the analysis of the whole.
+
+A finished analysis is written next to the stems as a small NumPy archive,
+``analysis-<stem>.npz``: a few kilobytes however long the track is. The
+page draws it as a waveform and a spectrogram without reading the stem.
+"""
+
+import os
+from collections import namedtuple
+
+import numpy as np
+
+ANALYSIS_PREFIX = "analysis-"
+# Points of the peak envelope and columns of the spectrogram across a track
+ENVELOPE_POINTS = 800
+SPECTROGRAM_COLUMNS = 400
+# Log-spaced frequency bands of the spectrogram, from LOWEST_FREQUENCY up
+SPECTROGRAM_BANDS = 64
+LOWEST_FREQUENCY = 40.0
+# STFT frames averaged into each spectrogram column, evenly spaced
+FRAMES_PER_COLUMN = 4
+# Spectrogram levels are stored as 0-255 over this many dB below full scale
+DYNAMIC_RANGE_DB = 96.0
+
+Analysis = namedtuple("Analysis", ["peaks", "spectrogram", "peak", "clipped"])
+
+
+def analysis_name(stem_name):
+    """File name of a stem's analysis"""
+    return f"{ANALYSIS_PREFIX}{os.path.splitext(stem_name)[0]}.npz"
+
+
+def band_matrix(sample_rate, frame_size, bands=SPECTROGRAM_BANDS):
+    """
+    ``(bins, bands)`` weights averaging the bins of each spectrogram band
+
+    A band narrower than a bin takes the bin nearest its centre, so low
+    bands repeat rather than drop out.
+    """
+    freqs = np.fft.rfftfreq(frame_size, 1.0 / sample_rate)
+    edges = np.geomspace(LOWEST_FREQUENCY, sample_rate / 2, bands + 1)
+    matrix = np.zeros((len(freqs), bands), dtype=np.float32)
+    for band, (low, high) in enumerate(zip(edges[:-1], edges[1:])):
+        inside = (freqs >= low) & (freqs < high)
+        if inside.any():
+            matrix[inside, band] = 1.0 / np.count_nonzero(inside)
+        else:
+            matrix[np.argmin(np.abs(freqs - np.sqrt(low * high))), band] = 1.0
+    return matrix
+
+
+class StemAnalysis:
+    """Peak envelope, clipping and spectrogram of one stem, filled in block by block"""
+
+    def __init__(self, frames, sample_rate, frame_size, hop_size):
+        self.bucket = max(1, -(-frames // ENVELOPE_POINTS))
+        points = -(-frames // self.bucket)
+        self.low = np.zeros(points, dtype=np.float32)
+        self.high = np.zeros(points, dtype=np.float32)
+        self.clipped = 0
+
+        spectra = -(-frames // hop_size)
+        per_column = max(1, -(-spectra // SPECTROGRAM_COLUMNS))
+        self.stride = max(1, per_column // FRAMES_PER_COLUMN)
+        # A whole number of strides, so every column averages as many frames
+        self.column = -(-per_column // self.stride) * self.stride
+        columns = -(-spectra // self.column)
+        self.power = np.zeros((columns, SPECTROGRAM_BANDS), dtype=np.float32)
+        self.counts = np.zeros(columns, dtype=np.int32)
+        self.bands = band_matrix(sample_rate, frame_size)
+        # Power of a full-scale sine in the bin it falls on
+        self.reference = (frame_size / 4) ** 2
+
+    def add_samples(self, first, samples):
+        """Fold in ``(frames, channels)`` float samples starting at frame ``first``"""
+        if not len(samples):
+            return
+        offsets, start = self._groups(first, len(samples), self.bucket)
+        stop = start + len(offsets)
+        # Reducing along the samples first is far faster than across two channels
+        low = np.minimum.reduceat(samples, offsets, axis=0).min(axis=1)
+        high = np.maximum.reduceat(samples, offsets, axis=0).max(axis=1)
+        self.low[start:stop] = np.minimum(self.low[start:stop], low)
+        self.high[start:stop] = np.maximum(self.high[start:stop], high)
+        if low.min() < -1.0 or high.max() > 1.0:
+            self.clipped += int(np.count_nonzero(np.abs(samples) > 1.0))
+
+    def add_spectrum(self, first, spectrum):
+        """Fold in the ``(channels, spectra, bins)`` STFT frames from number ``first`` on"""
+        # Only every stride-th frame of the track is measured
+        spectrum = spectrum[:, -first % self.stride::self.stride]
+        if not spectrum.shape[1]:
+            return
+        first += -first % self.stride
+        power = (spectrum.real ** 2 + spectrum.imag ** 2).mean(axis=0) @ self.bands
+        offsets, start = self._groups(first // self.stride, len(power), self.column // self.stride)
+        stop = start + len(offsets)
+        self.power[start:stop] += np.add.reduceat(power, offsets)
+        self.counts[start:stop] += np.diff(np.append(offsets, len(power))).astype(np.int32)
+
+    @staticmethod
+    def _groups(first, count, size):
+        """Offsets where each ``size`` group starts in ``count`` items from ``first``, and the first group"""
+        start = first // size
+        bounds = np.arange(start * size, first + count, size) - first
+        return np.maximum(bounds, 0), start
+
+    def save_state(self, path, position):
+        """Atomically save what has been folded in up to frame ``position``"""
+        with open(path + ".tmp", "wb") as state:
+            np.savez(
+                state, position=position, low=self.low, high=self.high, clipped=self.clipped,
+                power=self.power, counts=self.counts,
+            )
+        os.replace(path + ".tmp", path)
+
+    def restore(self, path, position):
+        """Load a state saved at frame ``position``; False if there is none"""
+        try:
+            with np.load(path) as state:
+                if int(state["position"]) != position or state["power"].shape != self.power.shape:
+                    return False
+                self.low, self.high = state["low"], state["high"]
+                self.clipped = int(state["clipped"])
+                self.power, self.counts = state["power"], state["counts"]
+        except (OSError, ValueError, KeyError):
+            return False
+        return True
+
+    def merge(self, other):
+        """Fold in an analysis of the same track made from other frames"""
+        self.low = np.minimum(self.low, other.low)
+        self.high = np.maximum(self.high, other.high)
+        self.clipped += other.clipped
+        self.power = self.power + other.power
+        self.counts = self.counts + other.counts
+
+    def write(self, path):
+        """Atomically write the finished analysis, compacted for display"""
+        power = self.power / np.maximum(self.counts, 1)[:, None] / self.reference
+        decibels = 10 * np.log10(np.maximum(power, 1e-12))
+        levels = np.clip((decibels + DYNAMIC_RANGE_DB) * (255 / DYNAMIC_RANGE_DB), 0, 255)
+        with open(path + ".tmp", "wb") as analysis:
+            np.savez(
+                analysis,
+                peaks=np.stack([self.low, self.high], axis=1).astype(np.float16),
+                spectrogram=levels.T.astype(np.uint8),
+                peak=max(-float(self.low.min(initial=0)), float(self.high.max(initial=0))),
+                clipped=self.clipped,
+            )
+        os.replace(path + ".tmp", path)
+
+
+def read_analysis(path):
+    """The Analysis saved at ``path``, or None if it cannot be read"""
+    try:
+        with np.load(path) as analysis:
+            return Analysis(
+                analysis["peaks"], analysis["spectrogram"], float(analysis["peak"]),
+                int(analysis["clipped"]),
+            )
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def waveform_image(peaks, height=48, color=(102, 126, 234)):
+    """RGB image of a peak envelope: one column per point, white background"""
+    middle = (height - 1) / 2
+    rows = np.arange(height)[:, None]
+    top = np.round(middle - np.clip(peaks[:, 1], -1, 1).astype(np.float32) * middle)
+    bottom = np.round(middle - np.clip(peaks[:, 0], -1, 1).astype(np.float32) * middle)
+    drawn = (rows >= top) & (rows <= bottom)
+    image = np.full((height, len(peaks), 3), 255, dtype=np.uint8)
+    image[drawn] = color
+    return image
+
+
+def spectrogram_image(spectrogram, color=(102, 126, 234)):
+    """RGB image of a spectrogram, low frequencies at the bottom, louder is darker"""
+    level = spectrogram[::-1].astype(np.float32)[:, :, None] / 255
+    return np.round(255 - level * (255 - np.array(color, dtype=np.float32))).astype(np.uint8)
@@ -0,0 +1,138 @@
+"""
+Audio container decoding and encoding
+
+WAV uploads are located, not loaded: the RIFF chunks are walked to find
+where the sample data starts and how it is laid out, so the pipeline can
+read it a block at a time and write stems behind the same header.
+Containers that are not parsed (MP3, FLAC, M4A, AAC, float or 24-bit WAV)
+return None; callers decode them to a 16-bit PCM WAV through ffmpeg first.
+
+Samples are scaled to floats in [-1, 1) for processing and back to their
+integer type, rounded and clipped, for writing.
+"""
+
+import shutil
+import struct
+import subprocess
+from collections import namedtuple
+
+import numpy as np
+
+# Upload extensions the app and the command line accept
+AUDIO_EXTENSIONS = ("mp3", "wav", "flac", "m4a", "aac")
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Little-endian PCM sample types, by sample width in bytes
+PCM_DTYPES = {
+    1: np.dtype("u1"),
+    2: np.dtype("<i2"),
+    4: np.dtype("<i4"),
+}
+
+# Where the samples live inside a WAV file
+WavLayout = namedtuple(
+    "WavLayout",
+    ["data_offset", "data_size", "sample_rate", "channels", "sample_width", "fmt_offset"],
+)
+
+def parse_wav_layout(head, total_size=None):
+    """
+    Locate the PCM data chunk of a WAV file
+
+    ``head`` only needs to cover the chunks up to the start of the sample
+    data; ``total_size`` is the full file length when ``head`` is partial.
+    Returns None when the file is not a WAV we can process as samples.
+    """
+    head = memoryview(head)
+    if total_size is None:
+        total_size = len(head)
+    if len(head) < 12 or head[0:4] != b"RIFF" or head[8:12] != b"WAVE":
+        return None
+
+    fmt = None
+    fmt_offset = None
+    pos = 12
+    while pos + 8 <= len(head):
+        chunk_id = bytes(head[pos:pos + 4])
+        (chunk_size,) = struct.unpack_from("<I", head, pos + 4)
+        body = pos + 8
+
+        if chunk_id == b"fmt ":
+            if chunk_size < 16 or body + 16 > len(head):
+                return None
+            fmt = list(struct.unpack_from("<HHIIHH", head, body))
+            fmt_offset = body
+            # WAVE_FORMAT_EXTENSIBLE keeps the real format in its sub-format GUID
+            if fmt[0] == WAVE_FORMAT_EXTENSIBLE:
+                if chunk_size < 40 or body + 26 > len(head):
+                    return None
+                (fmt[0],) = struct.unpack_from("<H", head, body + 24)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            format_tag, channels, sample_rate, _, block_align, bits = fmt
+            sample_width = bits // 8
+            if (
+                format_tag != WAVE_FORMAT_PCM
+                or bits % 8
+                or sample_width not in PCM_DTYPES
+                or channels < 1
+                or block_align != channels * sample_width
+            ):
+                return None
+            # Streamed or truncated files can declare more data than exists;
+            # a trailing partial frame is left to the trailer untouched
+            data_size = max(0, min(chunk_size, total_size - body))
+            data_size -= data_size % block_align
+            return WavLayout(body, data_size, sample_rate, channels, sample_width, fmt_offset)
+
+        pos = body + chunk_size + (chunk_size & 1)
+
+    return None
+
+
+def rewrite_wav_header(header, layout, sample_rate, data_size, file_size):
+    """
+    Copy of a WAV header describing a new sample rate and data size
+
+    ``header`` is everything up to the first sample and ``file_size`` the
+    length of the file the header will start.
+    """
+    header = bytearray(header)
+    block_align = layout.channels * layout.sample_width
+    struct.pack_into("<I", header, 4, file_size - 8)
+    struct.pack_into("<II", header, layout.fmt_offset + 4, sample_rate, sample_rate * block_align)
+    struct.pack_into("<I", header, layout.data_offset - 4, data_size)
+    return bytes(header)
+
+
+def pcm_to_float(samples):
+    """Integer PCM samples as float32 in [-1, 1)"""
+    info = np.iinfo(samples.dtype)
+    middle = (int(info.max) + int(info.min) + 1) // 2
+    scale = np.float32(1.0 / (int(info.max) + 1 - middle))
+    return (samples.astype(np.float32) - np.float32(middle)) * scale
+
+
+def float_to_pcm(values, dtype):
+    """Float samples in [-1, 1) as ``dtype`` PCM, rounded and clipped"""
+    info = np.iinfo(dtype)
+    middle = (int(info.max) + int(info.min) + 1) // 2
+    scaled = np.rint(values * np.float64(int(info.max) + 1 - middle)) + middle
+    return np.clip(scaled, info.min, info.max).astype(dtype)
+
+
+def can_decode():
+    """Whether ffmpeg is installed to decode containers other than PCM WAV"""
+    return shutil.which("ffmpeg") is not None
+
+
+def decode_to_wav(src_path, dst_path):
+    """Decode any audio file ffmpeg reads into a 16-bit PCM WAV"""
+    subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", src_path,
+         "-map", "0:a:0", "-codec:a", "pcm_s16le", "-f", "wav", dst_path],
+        check=True,
+    )
@@ -0,0 +1,172 @@
+"""
+Content-addressed result cache
+
+Finished separations are stored on local disk under a hash of the upload
+and its settings, so a repeated upload is served without recomputing. The
+cache is shared by every process on the host: entries are published with an
+atomic rename, hits are hard-linked out so eviction never pulls a file from
+under a reader, and eviction runs under an exclusive file lock, dropping the
+least recently used entries once the size cap is exceeded.
+
+Cached files are shared by link, so they must never be opened for writing
+after they are published.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: eviction is not coordinated between processes
+    fcntl = None
+
+CACHE_ROOT = os.environ.get(
+    "DISBAND_CACHE_DIR", os.path.join(tempfile.gettempdir(), "disband_cache")
+)
+CACHE_MAX_BYTES = int(os.environ.get("DISBAND_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+# Bump whenever stem output changes so stale entries stop matching
+CACHE_VERSION = "3"
+
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = ".lock"
+# Staging and trash folders left behind by a crashed process are swept after this
+STALE_SECONDS = 3600
+
+
+def cache_key(data, settings=()):
+    """Hash of the upload bytes and the settings that shape its output"""
+    digest = hashlib.sha256(CACHE_VERSION.encode("utf-8"))
+    digest.update(json.dumps(list(settings)).encode("utf-8"))
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Hard-link ``src`` to ``dst``, copying when they are on different filesystems"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ResultCache:
+    """LRU cache of result files on local disk, safe to share between processes"""
+
+    def __init__(self, root=CACHE_ROOT, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def _read_manifest(self, entry):
+        with open(os.path.join(entry, MANIFEST_NAME), encoding="utf-8") as manifest:
+            return json.load(manifest)
+
+    def _write_manifest(self, entry, names):
+        path = os.path.join(entry, MANIFEST_NAME)
+        staging = f"{path}.{uuid.uuid4().hex}"
+        with open(staging, "w", encoding="utf-8") as manifest:
+            json.dump(names, manifest)
+        os.replace(staging, path)
+
+    def get(self, key, dest_dir):
+        """
+        Link every file cached under ``key`` into ``dest_dir``
+
+        Returns ``{name: path}`` in the order the files were stored, or None
+        on a miss.
+        """
+        entry = self._entry(key)
+        paths = {}
+        try:
+            for name in self._read_manifest(entry):
+                paths[name] = os.path.join(dest_dir, name)
+                link_or_copy(os.path.join(entry, name), paths[name])
+            # The entry's mtime is its LRU position
+            os.utime(entry)
+        except (OSError, ValueError):
+            # Evicted mid-read: drop what was linked so nothing writes through it
+            for path in paths.values():
+                if os.path.exists(path):
+                    os.remove(path)
+            return None
+        return paths
+
+    def put(self, key, files):
+        """Publish ``{name: path}`` under ``key``; the first process to finish wins"""
+        staging = os.path.join(self.root, f".staging-{uuid.uuid4().hex}")
+        os.makedirs(staging)
+        try:
+            for name, path in files.items():
+                link_or_copy(path, os.path.join(staging, name))
+            self._write_manifest(staging, list(files))
+            os.rename(staging, self._entry(key))
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def add(self, key, name, path):
+        """Attach one more file to an existing entry, if it is still cached"""
+        entry = self._entry(key)
+        staging = os.path.join(entry, f".{name}.{uuid.uuid4().hex}")
+        try:
+            names = self._read_manifest(entry)
+            link_or_copy(path, staging)
+            os.replace(staging, os.path.join(entry, name))
+            if name not in names:
+                self._write_manifest(entry, names + [name])
+        except (OSError, ValueError):
+            if os.path.exists(staging):
+                os.remove(staging)
+            return
+        self.evict()
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.root, LOCK_NAME), "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits its size cap"""
+        with self._lock():
+            entries = []
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                try:
+                    info = os.stat(path)
+                    if name.startswith("."):
+                        if os.path.isdir(path) and time.time() - info.st_mtime > STALE_SECONDS:
+                            shutil.rmtree(path, ignore_errors=True)
+                        continue
+                    size = sum(entry.stat().st_size for entry in os.scandir(path))
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                # Renaming first makes the entry vanish atomically for readers
+                trash = os.path.join(self.root, f".trash-{uuid.uuid4().hex}")
+                try:
+                    os.rename(path, trash)
+                except OSError:
+                    continue
+                shutil.rmtree(trash, ignore_errors=True)
+                total -= size
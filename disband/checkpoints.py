@@ -0,0 +1,161 @@
+"""
+Resumable separations
+
+A job that is interrupted, because its worker was killed by a restart or
+its session went away, should not start over from the first byte of a
+long track. Each job works in a checkpoint folder named after its result
+cache key, so the same upload with the same settings finds the folder
+again. The stems are written there. Every ``interval`` bytes of input their
+files are flushed and the output position each one has reached is saved
+next to it. A rerun cuts the stems back to that position and carries on
+from it. Stems that were completely separated are marked finished and
+skipped. Encoders publish their output atomically, so a stem that was
+already encoded is skipped too.
+
+A folder is claimed with an exclusive file lock for as long as a job
+works in it. The lock dies with its process, so a crashed job's folder is
+free for the next one, while a duplicate of a live job waits for it and
+then finds the result in the cache. Folders nobody has claimed for a
+while are swept.
+
+Finished stems are moved out of the folder before they are cached, so no
+file is written after the result cache links to it.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: jobs run without checkpoints
+    fcntl = None
+
+CHECKPOINT_ROOT = os.environ.get(
+    "DISBAND_CHECKPOINT_DIR", os.path.join(tempfile.gettempdir(), "disband_checkpoints")
+)
+# Input bytes separated between two saves of the stems' position
+CHECKPOINT_BYTES = int(os.environ.get("DISBAND_CHECKPOINT_MB", 16)) * 1024 * 1024
+
+LOCK_NAME = ".lock"
+RECORD_SUFFIX = ".checkpoint"
+
+
+class Checkpoint:
+    """
+    The stems of one separation and how far each has got
+
+    Holds only the folder path, so it can be sent to other processes; the
+    lock stays with the process that claimed it.
+    """
+
+    def __init__(self, directory, interval=CHECKPOINT_BYTES):
+        self.directory = directory
+        self.interval = interval
+
+    def _record_path(self, name):
+        return os.path.join(self.directory, name + RECORD_SUFFIX)
+
+    def _read(self, name):
+        try:
+            with open(self._record_path(name), encoding="utf-8") as record:
+                return json.load(record)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, name, state):
+        path = self._record_path(name)
+        with open(path + ".tmp", "w", encoding="utf-8") as record:
+            json.dump(state, record)
+        os.replace(path + ".tmp", path)
+
+    def position(self, names):
+        """Output sample bytes that every stem in ``names`` has been saved up to"""
+        return min((self._read(name).get("position", 0) for name in names), default=0)
+
+    def save(self, names, position):
+        """Record that the stems in ``names`` hold the output up to ``position``"""
+        for name in names:
+            self._write(name, {"position": position})
+
+    def is_finished(self, name):
+        return self._read(name).get("finished", False)
+
+    def finish(self, name):
+        """Mark stem ``name`` as completely separated"""
+        self._write(name, {"finished": True})
+
+
+def lock_folder(directory, blocking=True):
+    """
+    Exclusive lock on a checkpoint folder, or None if it is taken
+
+    Retries when the folder is deleted and recreated while waiting, so the
+    lock always belongs to the folder now on disk.
+    """
+    while True:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, LOCK_NAME)
+        lock_file = open(path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        try:
+            if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+        except OSError:
+            pass
+        lock_file.close()
+
+
+@contextmanager
+def claim_checkpoint(key, on_wait=None, root=CHECKPOINT_ROOT):
+    """
+    Claim the checkpoint folder of ``key`` for the ``with`` block
+
+    Yields a Checkpoint, or None where file locks are unavailable. When
+    another process holds the folder, ``on_wait()`` is called and the
+    claim waits for it. The folder is deleted when the block completes and
+    kept for the next attempt when it raises.
+    """
+    if fcntl is None:
+        yield None
+        return
+    directory = os.path.join(root, key)
+    lock_file = lock_folder(directory, blocking=False)
+    if lock_file is None:
+        if on_wait:
+            on_wait()
+        lock_file = lock_folder(directory)
+    try:
+        yield Checkpoint(directory)
+        shutil.rmtree(directory, ignore_errors=True)
+    finally:
+        lock_file.close()
+
+
+def sweep_checkpoints(max_age, now=None, root=CHECKPOINT_ROOT):
+    """Delete checkpoint folders no job has touched for ``max_age`` seconds"""
+    if fcntl is None:
+        return
+    now = time.time() if now is None else now
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return
+    for name in names:
+        directory = os.path.join(root, name)
+        try:
+            if now - os.stat(directory).st_mtime <= max_age:
+                continue
+        except OSError:
+            continue
+        lock_file = lock_folder(directory, blocking=False)
+        if lock_file is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+            lock_file.close()
@@ -0,0 +1,158 @@
+"""
+Command line batch separation
+
+Separates whole directories of tracks without a browser session:
+
+    python -m disband music/ "incoming/**/*.wav" -o stems/ --jobs 4
+
+Each argument is an audio file, a directory searched recursively, or a glob.
+Every track gets its own folder in the output tree, mirroring where it was
+found, holding its stems and ZIP package. A track whose package already
+exists is skipped, so an interrupted run picks up where it stopped. An
+argument that matches no audio file is reported and fails the run. Only the
+processing modules are imported, never Streamlit.
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from disband.audio_io import AUDIO_EXTENSIONS
+from disband.encoders import DEFAULT_ENCODER, ENCODERS
+from disband.jobs import separate_file
+from disband.profiles import DEFAULT_PROFILE, PROFILES
+
+DEFAULT_OUTPUT = "disband_output"
+
+
+def is_audio(path):
+    """Whether ``path`` has one of the accepted upload extensions"""
+    return os.path.splitext(path)[1].lower().lstrip(".") in AUDIO_EXTENSIONS
+
+
+def find_tracks(inputs):
+    """
+    Expand file, directory and glob arguments into ``(path, relative path)``
+
+    Relative paths are taken from the directory argument, or from the
+    deepest folder all matches of a glob share. Returns the tracks and the
+    arguments that matched no audio file.
+    """
+    tracks = {}
+    unmatched = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            root = pattern
+            paths = [
+                os.path.join(folder, name)
+                for folder, _, names in os.walk(pattern)
+                for name in names
+            ]
+        else:
+            paths = [path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path)]
+            if not paths:
+                unmatched.append(pattern)
+                continue
+            root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+        root = os.path.abspath(root)
+        audio = sorted(os.path.abspath(path) for path in paths if is_audio(path))
+        if not audio:
+            unmatched.append(pattern)
+        for path in audio:
+            tracks.setdefault(path, os.path.relpath(path, root))
+    return list(tracks.items()), unmatched
+
+
+def package_path(track_dir, track_path):
+    """Where a track's ZIP package goes, named like the app's download"""
+    base = os.path.splitext(os.path.basename(track_path))[0]
+    return os.path.join(track_dir, f"DISBAND_{base}_Stems.zip")
+
+
+def process_track(track_path, track_dir, profile_name=DEFAULT_PROFILE, output_format=DEFAULT_ENCODER):
+    """Worker entry point: separate one track into its output folder"""
+    os.makedirs(track_dir, exist_ok=True)
+    stems = separate_file(
+        track_path, track_dir, profile_name, output_format,
+        package_path=package_path(track_dir, track_path),
+    )
+    return len(stems)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m disband",
+        description="🎵 DISBAND - separate audio files into stems",
+    )
+    parser.add_argument("inputs", nargs="+", help="audio files, directories or glob patterns")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT, help="output directory")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="tracks processed at the same time (default: one per core)",
+    )
+    parser.add_argument("-q", "--quality", choices=list(PROFILES), default=DEFAULT_PROFILE)
+    parser.add_argument("-f", "--format", choices=list(ENCODERS), default=DEFAULT_ENCODER)
+    parser.add_argument("--force", action="store_true", help="redo tracks that already have a package")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Separate every track found in the arguments; returns the exit status"""
+    args = parse_args(argv)
+    tracks, unmatched = find_tracks(args.inputs)
+    for pattern in unmatched:
+        print(f"❌ {pattern}: no audio files found", file=sys.stderr)
+    pending = []
+    for track_path, relative in tracks:
+        track_dir = os.path.join(args.output, os.path.splitext(relative)[0])
+        if not args.force and os.path.exists(package_path(track_dir, track_path)):
+            print(f"⏭️ {relative}: already separated")
+            continue
+        pending.append((track_path, relative, track_dir))
+    if not pending:
+        if unmatched:
+            return 1
+        print("✅ Nothing to do")
+        return 0
+
+    failed = 0
+
+    def finished(relative, track_dir, stems, error):
+        nonlocal failed
+        if error is not None:
+            failed += 1
+            print(f"❌ {relative}: {error}")
+        else:
+            print(f"✅ {relative}: {stems} stems in {track_dir}")
+
+    if args.jobs <= 1:
+        for track_path, relative, track_dir in pending:
+            try:
+                stems = process_track(track_path, track_dir, args.quality, args.format)
+            except Exception as error:
+                finished(relative, track_dir, 0, error)
+            else:
+                finished(relative, track_dir, stems, None)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=args.jobs, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = {
+                executor.submit(process_track, track_path, track_dir, args.quality, args.format):
+                (relative, track_dir)
+                for track_path, relative, track_dir in pending
+            }
+            for future in as_completed(futures):
+                relative, track_dir = futures[future]
+                error = future.exception()
+                finished(relative, track_dir, 0 if error else future.result(), error)
+
+    print(f"🎉 {len(pending) - failed} of {len(pending)} tracks separated")
+    return 1 if failed or unmatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
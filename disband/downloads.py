@@ -0,0 +1,191 @@
+"""
+Download server for results
+
+A Streamlit download button or audio player hands its file to the browser
+through the app's own media store, which holds the whole file in memory
+for as long as the element is on the page. This module serves result
+files over plain HTTP instead, so the page only carries links.
+
+Files are published one at a time and reached through an unguessable
+token, never by their path on disk. The server answers HEAD, single-range
+``Range`` and ``If-Range`` requests, so players can seek and browsers can
+resume a broken download, and revalidates with an ETag built from the
+file's inode, size and modification time: results are never rewritten in
+place, so it changes whenever the content does. Bodies are sent with
+``socket.sendfile``, straight from the page cache to the socket.
+
+The server starts when DISBAND_DOWNLOADS_PORT is set. Links point at the
+host the page was loaded from on that port, or at DISBAND_DOWNLOADS_URL
+behind a proxy. A token stops working once its file is deleted.
+"""
+
+import os
+import re
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+
+from disband.encoders import mime_for
+
+# Port of the download server; unset keeps it off
+DOWNLOADS_PORT = os.environ.get("DISBAND_DOWNLOADS_PORT")
+# Public base URL of the server, when it is not the page's host on DOWNLOADS_PORT
+DOWNLOADS_URL = os.environ.get("DISBAND_DOWNLOADS_URL")
+# Seconds browsers may reuse a file before revalidating it
+MAX_AGE = 3600
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+
+_server = None
+_lock = threading.Lock()
+
+
+def file_etag(stat):
+    """Strong ETag of a file that is only ever replaced, never rewritten"""
+    return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """
+    ``(start, stop)`` of a ``Range`` header, None to send the whole file
+
+    Raises ValueError when the range lies outside the file. Lists of
+    ranges are answered with the whole file, as HTTP allows.
+    """
+    match = RANGE_PATTERN.match(header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        start, stop = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        stop = size if last == "" else min(int(last) + 1, size)
+    if start >= stop:
+        raise ValueError(f"Range {header} outside {size} bytes")
+    return start, stop
+
+
+class DownloadServer:
+    """Serves published files from a daemon thread"""
+
+    def __init__(self, port, host="0.0.0.0"):
+        self._files = {}
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, int(port)), self._handler())
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def publish(self, path):
+        """Token of ``path``, the same one on every call"""
+        path = os.path.realpath(path)
+        with self._lock:
+            token = self._tokens.get(path)
+            if token is None:
+                # Forget deleted results before adding one
+                for gone in [known for known in self._tokens if not os.path.exists(known)]:
+                    del self._files[self._tokens.pop(gone)]
+                token = secrets.token_urlsafe(16)
+                self._tokens[path] = token
+                self._files[token] = path
+            return token
+
+    def lookup(self, token):
+        """Path published under ``token``, or None"""
+        with self._lock:
+            return self._files.get(token)
+
+    def url_for(self, path, filename, base_url):
+        """Link to download ``path`` as ``filename`` from ``base_url``"""
+        return f"{base_url.rstrip('/')}/files/{self.publish(path)}/{quote(filename)}"
+
+    def _handler(self):
+        server = self
+
+        class DownloadHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                self.serve(body=False)
+
+            def do_GET(self):
+                self.serve(body=True)
+
+            def serve(self, body):
+                parts = self.path.split("?", 1)[0].split("/")
+                path = server.lookup(parts[2]) if len(parts) == 4 and parts[1] == "files" else None
+                try:
+                    result_file = open(path, "rb") if path else None
+                except OSError:
+                    result_file = None
+                if result_file is None:
+                    self.send_error(404)
+                    return
+                with result_file:
+                    self.send_file(result_file, unquote(parts[3]), body)
+
+            def send_file(self, result_file, filename, body):
+                stat = os.fstat(result_file.fileno())
+                size, etag = stat.st_size, file_etag(stat)
+                if etag in self.headers.get("If-None-Match", ""):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                span = None
+                requested = self.headers.get("Range")
+                # A stale If-Range asks for the whole new file instead of a piece of it
+                if requested and self.headers.get("If-Range", etag) == etag:
+                    try:
+                        span = parse_range(requested, size)
+                    except ValueError:
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{size}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                if span:
+                    start, stop = span
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{stop - 1}/{size}")
+                else:
+                    start, stop = 0, size
+                    self.send_response(200)
+                self.send_header("Content-Type", mime_for(filename))
+                self.send_header("Content-Length", str(stop - start))
+                self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(filename)}")
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", f"private, max-age={MAX_AGE}")
+                self.end_headers()
+                if body and stop > start:
+                    self.wfile.flush()
+                    self.connection.sendfile(result_file, start, stop - start)
+
+            def log_message(self, format, *args):
+                pass
+
+        return DownloadHandler
+
+
+def get_download_server():
+    """Download server of this process, started on first use, or None when it is off"""
+    global _server
+    if not DOWNLOADS_PORT:
+        return None
+    with _lock:
+        if _server is None:
+            _server = DownloadServer(DOWNLOADS_PORT)
+        return _server
+
+
+def base_url(host):
+    """Base of download links for a page served from ``host``"""
+    if DOWNLOADS_URL:
+        return DOWNLOADS_URL
+    hostname = re.sub(r":\d+$", "", host or "localhost")
+    return f"http://{hostname}:{get_download_server().port}"
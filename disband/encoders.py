@@ -0,0 +1,377 @@
+"""
+Output format encoders
+
+Stems leave the pipeline as PCM WAV; an encoder turns one stem file into the
+format the user picked and streams the result straight to disk. Encoders are
+looked up by name in ENCODERS, so a new format only needs a new entry; one
+that cannot handle a stem's layout (or whose tool is missing) falls back to
+WAV.
+
+The FLAC encoder is pure NumPy: every block is coded with the cheapest FIXED
+predictor (orders 0-4) and a single Rice partition, or stored verbatim when
+that is smaller. The few blocks of a read window are predicted, Rice coded
+and bit-packed together, so Python only loops over frames to lay out their
+fields, and over pairs of bytes for each frame's CRC. Only the chosen
+order's codes are kept, which holds the encoder to a few MB. MP3 is
+encoded through ffmpeg when it is installed.
+"""
+
+import mimetypes
+import os
+import shutil
+import struct
+import subprocess
+from collections import namedtuple
+from concurrent.futures import as_completed
+
+import numpy as np
+
+from disband.audio_io import PCM_DTYPES, parse_wav_layout
+from disband.pipeline import HEADER_PROBE_SIZE, iter_windows
+
+Encoder = namedtuple("Encoder", ["extension", "mime", "encode", "supports"])
+
+# Samples per FLAC block, per channel; fewer for many channels
+FLAC_BLOCK_SAMPLES = 4096
+# Blocks encoded together per read window; each costs about 1 MB of buffers
+FLAC_BLOCKS_PER_WINDOW = 4
+# Widest single field the bit packer handles
+MAX_FIELD_BITS = 57
+MAX_RICE_PARAMETER = 14
+
+_crc16_table = None
+
+
+def encode_wav(src_path, dst_path):
+    """Stems are already WAV: link or copy them into place"""
+    if os.path.exists(dst_path):
+        os.remove(dst_path)
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+
+def encode_mp3(src_path, dst_path):
+    """MP3 at 320 kbit/s through ffmpeg"""
+    subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", src_path,
+         "-codec:a", "libmp3lame", "-b:a", "320k", dst_path],
+        check=True,
+    )
+
+
+def mp3_available():
+    """Whether ffmpeg is installed to encode MP3"""
+    return shutil.which("ffmpeg") is not None
+
+
+def pack_bits(widths, values):
+    """
+    Concatenate fields MSB first into bytes
+
+    ``widths`` are bit counts of at most MAX_FIELD_BITS and ``values`` the
+    unsigned field contents, already masked to their width.
+    """
+    widths = widths.astype(np.uint64)
+    values = values.astype(np.uint64)
+    ends = np.cumsum(widths)
+    starts = ends - widths
+    total_bits = int(ends[-1]) if len(ends) else 0
+    words = np.zeros((total_bits + 63) // 64 + 1, dtype=np.uint64)
+
+    index = (starts >> np.uint64(6)).astype(np.int64)
+    offset = starts & np.uint64(63)
+    fits = offset + widths <= 64
+    # Fields that fit in their word are shifted up to their position, the
+    # rest are split with their low bits spilling into the next word
+    shift_in = np.where(fits, 64 - offset - widths, 0).astype(np.uint64)
+    spill = np.where(fits, 0, offset + widths - 64).astype(np.uint64)
+    head = np.where(fits, values << shift_in, values >> spill)
+    tail = np.where(fits, 0, values << ((64 - spill) & np.uint64(63)))
+
+    for target, parts in ((index, head), (index + 1, tail)):
+        group = np.flatnonzero(np.diff(target, prepend=-1))
+        words[target[group]] |= np.bitwise_or.reduceat(parts, group)
+
+    return words.astype(">u8").tobytes()[:(total_bits + 7) // 8]
+
+
+def crc8(data):
+    """FLAC frame header CRC (polynomial 0x07)"""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+def crc16_table():
+    """
+    FLAC CRC-16 (polynomial 0x8005) of every byte value and of every pair
+
+    ``(bytes, pairs)``: the register is 16 bits wide, so two bytes at a time
+    the next value is just ``pairs[crc ^ next two bytes]``.
+    """
+    global _crc16_table
+    if _crc16_table is None:
+        table = np.zeros(256, dtype=np.int64)
+        for byte in range(256):
+            crc = byte << 8
+            for _ in range(8):
+                crc = ((crc << 1) ^ 0x8005) & 0xFFFF if crc & 0x8000 else (crc << 1) & 0xFFFF
+            table[byte] = crc
+        high, low = np.divmod(np.arange(1 << 16), 256)
+        pairs = ((table[high] << 8) & 0xFFFF) ^ table[(table[high] >> 8) ^ low]
+        _crc16_table = (table.tolist(), pairs.tolist())
+    return _crc16_table
+
+
+def crc16(data):
+    """FLAC frame footer CRC of ``data``, a table lookup per pair of bytes"""
+    table, pairs = crc16_table()
+    crc = 0
+    even = len(data) & ~1
+    for pair in np.frombuffer(data[:even], dtype=">u2").tolist():
+        crc = pairs[crc ^ pair]
+    if even < len(data):
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ data[even]]
+    return crc
+
+
+def utf8_number(number):
+    """FLAC's UTF-8 style coding of a frame number"""
+    if number < 0x80:
+        return bytes([number])
+    length = 2
+    while number >= 1 << (5 * length + 1):
+        length += 1
+    out = [0x80 | ((number >> (6 * i)) & 0x3F) for i in range(length - 1)][::-1]
+    lead = (0xFF00 >> length) & 0xFF | (number >> (6 * (length - 1)))
+    return bytes([lead] + out)
+
+
+def flac_streaminfo(sample_rate, channels, bits, total_samples, block_samples):
+    """``fLaC`` marker plus a STREAMINFO block, flagged as the last metadata block"""
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | total_samples
+    body = struct.pack(">HH", block_samples, block_samples) + b"\0" * 6
+    body += struct.pack(">Q", packed) + b"\0" * 16
+    return b"fLaC" + bytes([0x80]) + len(body).to_bytes(3, "big") + body
+
+
+def rice_parameters(residuals):
+    """
+    Pick a Rice parameter per block
+
+    ``residuals`` has shape ``(blocks, n)``. Returns per-block parameters
+    and total coded bits; blocks whose codes would exceed MAX_FIELD_BITS
+    get a cost of infinity.
+    """
+    folded = (residuals << 1) ^ (residuals >> 63)
+    n = folded.shape[1]
+    mean = folded.sum(axis=1) / max(n, 1)
+    estimate = np.clip(np.floor(np.log2(np.maximum(mean, 1))), 0, MAX_RICE_PARAMETER).astype(np.int64)
+
+    best_cost = np.full(len(folded), np.inf)
+    best_param = estimate.copy()
+    for delta in (-1, 0, 1):
+        param = np.clip(estimate + delta, 0, MAX_RICE_PARAMETER)
+        cost = (folded >> param[:, None]).sum(axis=1) + n * (param + 1)
+        better = cost < best_cost
+        best_cost[better] = cost[better]
+        best_param[better] = param[better]
+
+    too_wide = (folded.max(axis=1, initial=0) >> best_param) + 1 + best_param > MAX_FIELD_BITS
+    best_cost[too_wide] = np.inf
+    return best_param, best_cost
+
+
+def rice_codes(residuals, param):
+    """``(widths, values)`` of the Rice code of every residual, with a parameter per block"""
+    folded = (residuals << 1) ^ (residuals >> 63)
+    param = param[:, None]
+    return (folded >> param) + 1 + param, (folded & ((1 << param) - 1)) | (1 << param)
+
+
+def encode_flac_blocks(blocks, bits, first_frame):
+    """
+    FLAC frames for ``blocks`` of shape ``(frames, n, channels)``
+
+    Every subframe uses the FIXED predictor order with the fewest coded
+    bits, or VERBATIM when that is smaller or a code would be too wide.
+    """
+    frames, n, channels = blocks.shape
+    samples = blocks.transpose(0, 2, 1).reshape(frames * channels, n).astype(np.int64)
+    mask = (1 << bits) - 1
+
+    best_cost = np.full(len(samples), float(n * bits))
+    best_order = np.full(len(samples), -1)
+    best_param = np.zeros(len(samples), dtype=np.int64)
+    for order in range(min(4, n - 1) + 1):
+        param, cost = rice_parameters(np.diff(samples, n=order, axis=1))
+        cost = cost + order * bits + 10
+        better = cost < best_cost
+        best_cost[better] = cost[better]
+        best_order[better] = order
+        best_param[better] = param[better]
+
+    # Codes only for the subframes that use each order: row -> (widths, values)
+    coded = {}
+    for order in np.unique(best_order[best_order >= 0]):
+        rows = np.flatnonzero(best_order == order)
+        widths, values = rice_codes(np.diff(samples[rows], n=order, axis=1), best_param[rows])
+        coded.update(zip(rows.tolist(), zip(widths, values)))
+
+    size_code = {8: 1, 16: 4}[bits]
+    widths, values, frame_lengths = [], [], []
+    for frame in range(frames):
+        first_field = len(widths)
+        header = bytearray(b"\xff\xf8")
+        header.append(0x70)
+        header.append(((channels - 1) << 4) | (size_code << 1))
+        header += utf8_number(first_frame + frame)
+        header += struct.pack(">H", n - 1)
+        header.append(crc8(header))
+        widths.append(np.full(len(header), 8))
+        values.append(np.frombuffer(bytes(header), dtype=np.uint8))
+
+        for channel in range(channels):
+            row = frame * channels + channel
+            order = best_order[row]
+            if order < 0:
+                widths += [np.array([8]), np.full(n, bits)]
+                values += [np.array([0x02]), samples[row] & mask]
+                continue
+            code_widths, code_values = coded[row]
+            widths += [np.array([8]), np.full(order, bits), np.array([6, 4]), code_widths]
+            values += [
+                np.array([0x10 | order << 1]),
+                samples[row, :order] & mask,
+                np.array([0, best_param[row]]),
+                code_values,
+            ]
+        # Zero padding to a byte boundary and a placeholder for the CRC-16
+        frame_bits = sum(int(w.sum()) for w in widths[first_field:])
+        widths += [np.array([-frame_bits % 8, 16])]
+        values += [np.array([0, 0])]
+        frame_lengths.append((frame_bits + 7) // 8 + 2)
+
+    widths = np.concatenate(widths)
+    values = np.concatenate(values)
+    keep = widths > 0
+    frame_ends = np.cumsum(frame_lengths) - 2
+    frame_starts = frame_ends + 2 - np.array(frame_lengths)
+
+    data = bytearray(pack_bits(widths[keep], values[keep]))
+    view = memoryview(data)
+    for start, end in zip(frame_starts.tolist(), frame_ends.tolist()):
+        view[end:end + 2] = crc16(view[start:end]).to_bytes(2, "big")
+    return bytes(data)
+
+
+def flac_supported(layout):
+    """FLAC is written for 8- and 16-bit PCM WAV stems"""
+    return layout is not None and layout.sample_width in (1, 2)
+
+
+def encode_flac(src_path, dst_path):
+    """Lossless FLAC, streamed window by window"""
+    total_size = os.path.getsize(src_path)
+    with open(src_path, "rb") as source, open(dst_path, "wb") as sink:
+        layout = parse_wav_layout(source.read(HEADER_PROBE_SIZE), total_size)
+        if not flac_supported(layout):
+            raise ValueError("FLAC needs an 8- or 16-bit PCM WAV stem")
+
+        channels = layout.channels
+        bits = layout.sample_width * 8
+        dtype = PCM_DTYPES[layout.sample_width]
+        block = max(16, min(FLAC_BLOCK_SAMPLES, 8192 // channels))
+        frame_bytes = channels * layout.sample_width
+        total_frames = layout.data_size // frame_bytes
+        sink.write(flac_streaminfo(layout.sample_rate, channels, bits, total_frames, block))
+
+        source.seek(layout.data_offset)
+        frame_number = 0
+        window_size = block * frame_bytes * FLAC_BLOCKS_PER_WINDOW
+        for _, window in iter_windows(source, total_frames * frame_bytes, window_size):
+            pcm = np.frombuffer(window, dtype=dtype).reshape(-1, channels)
+            if bits == 8:
+                # WAV stores 8-bit audio unsigned, FLAC signed
+                pcm = pcm.astype(np.int16) - 128
+            full = len(pcm) // block
+            if full:
+                sink.write(encode_flac_blocks(pcm[:full * block].reshape(full, block, channels), bits, frame_number))
+                frame_number += full
+            if len(pcm) % block:
+                sink.write(encode_flac_blocks(pcm[full * block:][None], bits, frame_number))
+                frame_number += 1
+
+
+ENCODERS = {
+    "wav": Encoder(".wav", "audio/wav", encode_wav, lambda layout: True),
+    "flac": Encoder(".flac", "audio/flac", encode_flac, flac_supported),
+    "mp3": Encoder(".mp3", "audio/mpeg", encode_mp3, lambda layout: mp3_available()),
+}
+DEFAULT_ENCODER = "wav"
+
+
+def choose_encoder(name, layout):
+    """Name of the encoder to use for stems of ``layout``, falling back to WAV"""
+    encoder = ENCODERS.get(name)
+    if encoder is None or layout is None or not encoder.supports(layout):
+        return DEFAULT_ENCODER
+    return name
+
+
+def mime_for(filename):
+    """MIME type of an output file, by extension"""
+    extension = os.path.splitext(filename)[1].lower()
+    for encoder in ENCODERS.values():
+        if encoder.extension == extension:
+            return encoder.mime
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def encode_stem(encoder_name, src_path, dst_path):
+    """
+    Worker entry point: encode one stem and drop its WAV
+
+    The output is renamed into place once complete, so an output without
+    its WAV is a stem an interrupted run already encoded.
+    """
+    if src_path == dst_path or (os.path.exists(dst_path) and not os.path.exists(src_path)):
+        return dst_path
+    partial = os.path.join(os.path.dirname(dst_path), ".partial-" + os.path.basename(dst_path))
+    ENCODERS[encoder_name].encode(src_path, partial)
+    os.replace(partial, dst_path)
+    os.remove(src_path)
+    return dst_path
+
+
+def encode_stems(stems, encoder_name, executor=None):
+    """
+    Encode ``{name: wav path}`` stems, yielding ``(name, path)`` as each is done
+
+    Output files sit next to their WAV under the encoder's extension. With
+    an ``executor`` the stems encode concurrently and are yielded in
+    completion order, so a consumer such as the ZIP packager can start on
+    the first while the rest are encoding.
+    """
+    extension = ENCODERS[encoder_name].extension
+    targets = {
+        os.path.splitext(name)[0] + extension: (path, os.path.splitext(path)[0] + extension)
+        for name, path in stems.items()
+    }
+    # Renaming WAVs is not worth a round trip to another process
+    if executor is None or encoder_name == DEFAULT_ENCODER:
+        for name, (src_path, dst_path) in targets.items():
+            yield name, encode_stem(encoder_name, src_path, dst_path)
+        return
+
+    futures = {
+        executor.submit(encode_stem, encoder_name, src_path, dst_path): name
+        for name, (src_path, dst_path) in targets.items()
+    }
+    for future in as_completed(futures):
+        yield futures[future], future.result()
@@ -0,0 +1,748 @@
+"""
+Background separation jobs
+
+Separations run in a process pool so a Streamlit script run only submits
+work and polls it. Each job owns a folder holding the uploaded input, a
+small progress file written by the worker, and the finished stems. Uploads
+seen before with the same settings are served from the result cache.
+
+The job pool has a worker per core. Large uploads are cut into ranges of
+the track that a second, per-worker pool separates side by side; a job
+spreads its ranges over its share of the cores, all of them when it runs
+alone and none beyond its own when every core already has a job.
+
+Jobs do not go to the pool directly. A bounded FIFO queue admits the next
+job once a worker is free and the uploads being processed leave room for
+its size. Each session holds one job at a time, so first come first served
+is fair between sessions. A full queue turns new jobs away with QueueFull
+rather than letting everyone's latency grow without bound.
+
+Once separated, the worker encodes the stems into the requested output
+format, on the same range pool when the profile allows it, and writes the ZIP
+package as each stem finishes encoding. ``separate_file`` does that work
+for any file on disk, so the command line runs the same code without a job
+folder.
+
+Before the full separation, and after decoding an upload that is not a
+WAV, a worker writes the first PREVIEW_SECONDS of every stem to the job
+folder, so the page can play them while the rest is processed. During it,
+each stem's waveform and spectrogram overview is written next to the
+stems and cached with them.
+
+A job separates and encodes in a checkpoint folder named after its cache
+key, saving its position as it goes, so the same upload submitted again
+after a restart carries on where the last attempt stopped.
+
+Every stage of a job is timed into its folder's metrics record, which the
+server folds into the Prometheus metrics once the job is done.
+
+Job folders are also the result store: sessions keep only a job ID and file
+paths, results are read through a memory map when downloaded, and finished
+jobs are deleted when their session ends, when they go unused for JOB_TTL
+seconds, or oldest first once the folders outgrow JOBS_MAX_BYTES.
+"""
+
+import collections
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from disband.analysis import ANALYSIS_PREFIX, analysis_name
+from disband.audio_io import can_decode, decode_to_wav, parse_wav_layout
+from disband.cache import ResultCache, cache_key
+from disband.checkpoints import claim_checkpoint, sweep_checkpoints
+from disband.encoders import DEFAULT_ENCODER, choose_encoder, encode_stems
+from disband.metrics import StageRecorder, format_duration, get_registry, read_metrics, write_metrics
+from disband.packaging import create_zip_package
+from disband.pipeline import (
+    HEADER_PROBE_SIZE, separate_in_parallel, separate_to_directory, write_previews,
+)
+from disband.profiles import DEFAULT_PROFILE, get_profile
+from disband.stems import STEM_NAMES
+
+JOBS_ROOT = os.path.join(tempfile.gettempdir(), "disband_jobs")
+INPUT_NAME = "input"
+PROGRESS_NAME = "progress.json"
+PREVIEW_PREFIX = "preview-"
+# PCM copy of an upload that is not a PCM WAV
+DECODED_NAME = "decoded.wav"
+# Length of the stem previews published before a job finishes; 0 turns them off
+PREVIEW_SECONDS = float(os.environ.get("DISBAND_PREVIEW_SECONDS", 10))
+
+CPU_COUNT = os.cpu_count() or 1
+# Jobs processed at once, one per job pool worker
+JOB_WORKERS = int(os.environ.get("DISBAND_JOB_WORKERS", CPU_COUNT))
+# Most processes one job spreads its ranges and encodes over; 1 keeps every
+# job sequential. Each job worker keeps this many alive once used.
+RANGE_WORKERS = int(os.environ.get("DISBAND_RANGE_WORKERS", min(4, CPU_COUNT)))
+# Jobs waiting for a worker before new ones are turned away
+MAX_QUEUED = int(os.environ.get("DISBAND_MAX_QUEUED", 32))
+# Upload bytes processed at once; a larger upload runs on its own
+MAX_INFLIGHT_BYTES = int(os.environ.get("DISBAND_MAX_INFLIGHT_MB", 1024)) * 1024 * 1024
+# Below this size streaming in one process beats the fan-out overhead
+PARALLEL_MIN_BYTES = 4 * 1024 * 1024
+# Share of a job's progress bar spent separating when stems are encoded after
+SEPARATION_SHARE = 0.6
+
+# Seconds a finished job is kept after its results were last shown
+JOB_TTL = int(os.environ.get("DISBAND_JOB_TTL", 3600))
+# Size cap of all job folders together
+JOBS_MAX_BYTES = int(os.environ.get("DISBAND_JOBS_MAX_MB", 4096)) * 1024 * 1024
+# Seconds between sweeps of expired job folders
+SWEEP_INTERVAL = 60
+
+JobStatus = namedtuple("JobStatus", ["state", "progress", "message", "stems", "metrics"])
+# A job waiting in the queue: its upload size and the arguments of run_job
+QueuedJob = namedtuple("QueuedJob", ["job_id", "size", "args"])
+
+_executor = None
+_range_executor = None
+_lock = threading.Lock()
+# job_id -> (job_dir, cache key, future), for jobs submitted by this server process
+_jobs = {}
+# Finished jobs whose metrics are already in the registry
+_observed = set()
+_last_sweep = 0.0
+# Jobs waiting for a worker, oldest first
+_queue = collections.deque()
+# job_id -> upload size, for jobs handed to the pool
+_running = {}
+
+
+class QueueFull(Exception):
+    """The job queue is at capacity; the caller should try again later"""
+
+
+def get_executor():
+    """Process pool shared by every session of this server"""
+    global _executor
+    with _lock:
+        if _executor is None:
+            # Spawned workers import only the processing modules, never the UI
+            _executor = ProcessPoolExecutor(
+                max_workers=JOB_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def get_range_executor():
+    """Pool a job worker uses to separate ranges of a track and encode stems in parallel"""
+    global _range_executor
+    with _lock:
+        if _range_executor is None:
+            _range_executor = ProcessPoolExecutor(
+                max_workers=RANGE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            # A pool worker exits without running atexit hooks, after joining
+            # its children; shut the range pool down first or that join never
+            # ends. It has to run before the pool's queues close (priority 10).
+            multiprocessing.util.Finalize(_range_executor, _range_executor.shutdown, exitpriority=20)
+        return _range_executor
+
+
+def discard_executor(executor):
+    """
+    Forget a pool one of whose workers died, so the next user starts a fresh one
+
+    A killed worker (by the OOM killer, say) breaks its whole pool for good.
+    The broken pool has already shut itself down.
+    """
+    global _executor, _range_executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+        if _range_executor is executor:
+            _range_executor = None
+
+
+def write_progress(job_dir, progress, message):
+    """Atomically replace a job's progress file"""
+    path = os.path.join(job_dir, PROGRESS_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as progress_file:
+        json.dump({"progress": progress, "message": message}, progress_file)
+    os.replace(path + ".tmp", path)
+
+
+def read_progress(job_dir):
+    """Last progress reported by a job's worker"""
+    try:
+        with open(os.path.join(job_dir, PROGRESS_NAME), encoding="utf-8") as progress_file:
+            state = json.load(progress_file)
+    except (OSError, ValueError):
+        return 0.0, "🔍 Analyzing audio spectrum..."
+    return state["progress"], state["message"]
+
+
+def package_name(original_name):
+    """
+    File name of a job's ZIP package
+
+    The package embeds the uploaded file name, so each name gets its own
+    cached copy.
+    """
+    return f"package-{hashlib.sha256(original_name.encode('utf-8')).hexdigest()[:16]}.zip"
+
+
+def source_extension(original_name):
+    """Extension of an uploaded file, ``.wav`` when it has none"""
+    return os.path.splitext(original_name or "")[1].lower() or ".wav"
+
+
+def separate_file(input_path, out_dir, profile_name=DEFAULT_PROFILE, output_format=DEFAULT_ENCODER,
+                  original_name=None, package_path=None, report=None, range_executor=None,
+                  recorder=None, checkpoint=None, analyze=False, preview=None,
+                  range_workers=RANGE_WORKERS):
+    """
+    Separate and encode the track at ``input_path`` into ``out_dir``
+
+    Input other than PCM WAV is decoded with ffmpeg first. WAV stems are
+    encoded as ``output_format``, or kept as WAV when that encoder cannot
+    handle them. With a ``package_path`` the ZIP package is written there
+    as the stems finish encoding.
+
+    ``report(progress, message)`` receives progress updates when the
+    profile asks for them; with a ``range_executor`` large inputs are
+    separated in ranges, ``range_workers`` at a time, and every input
+    encodes its stems, on that pool. Each stage is timed into ``recorder``
+    when one is given. With a ``checkpoint`` the stems
+    are built in its folder, picking up an interrupted run, and moved to
+    ``out_dir`` once packaged. ``preview(path)`` is called with the PCM
+    WAV about to be separated, decoded or not, before separation starts.
+    Returns ``{file name: path}`` of the stems in pipeline order, followed
+    by their analyses with ``analyze``.
+    """
+    profile = get_profile(profile_name)
+    recorder = recorder or StageRecorder()
+    original_name = original_name or os.path.basename(input_path)
+    work_dir = checkpoint.directory if checkpoint is not None else out_dir
+    total_size = os.path.getsize(input_path)
+    with recorder.stage("analyze", min(total_size, HEADER_PROBE_SIZE)):
+        with open(input_path, "rb") as source:
+            layout = parse_wav_layout(source.read(HEADER_PROBE_SIZE), total_size)
+    decoded = None
+    if layout is None:
+        decoded = os.path.join(work_dir, DECODED_NAME)
+        with recorder.stage("decode", total_size):
+            # A checkpoint keeps the copy decoded by an interrupted run
+            if not os.path.exists(decoded):
+                if not can_decode():
+                    raise ValueError(
+                        f"Only PCM WAV can be separated without ffmpeg, got {source_extension(original_name)}"
+                    )
+                decode_to_wav(input_path, decoded + ".tmp")
+                os.replace(decoded + ".tmp", decoded)
+        input_path = decoded
+        total_size = os.path.getsize(decoded)
+        recorder.add("decode", bytes_out=total_size)
+        with open(decoded, "rb") as source:
+            layout = parse_wav_layout(source.read(HEADER_PROBE_SIZE), total_size)
+    if preview is not None:
+        preview(input_path)
+    encoder_name = choose_encoder(output_format, layout)
+    share = 1.0 if encoder_name == DEFAULT_ENCODER else SEPARATION_SHARE
+    if not profile.report_progress:
+        report = None
+
+    def on_progress(done, total):
+        report(share * done / total, "🎵 Separating frequencies...")
+
+    with recorder.stage("separate", total_size):
+        if range_executor is not None and total_size >= PARALLEL_MIN_BYTES:
+            stems = separate_in_parallel(
+                input_path, total_size, work_dir, range_executor, range_workers,
+                profile.window_size, on_progress if report else None, profile.stems,
+                profile.resample_rate, checkpoint, analyze,
+            )
+        else:
+            with open(input_path, "rb") as source:
+                stems = separate_to_directory(
+                    source, total_size, work_dir, profile.window_size,
+                    on_progress if report else None, profile.stems, profile.resample_rate,
+                    checkpoint, analyze,
+                )
+
+    # The WAV of a stem an interrupted run already encoded is gone
+    stem_bytes = {name: os.path.getsize(path) for name, path in stems.items() if os.path.exists(path)}
+    recorder.add("separate", bytes_out=sum(stem_bytes.values()))
+    encoded = {}
+
+    def encoded_stems():
+        pending = encode_stems(stems, encoder_name, executor=range_executor)
+        while True:
+            with recorder.stage("encode"):
+                item = next(pending, None)
+            if item is None:
+                return
+            name, path = item
+            encoded[name] = path
+            recorder.add("encode", bytes_out=os.path.getsize(path))
+            if report:
+                report(share + (1.0 - share) * len(encoded) / len(stems), "🎛️ Encoding stems...")
+            # The packager writes this stem's entry before asking for the next
+            with recorder.stage("package" if package_path else "encode"):
+                yield name, path
+
+    recorder.add("encode", bytes_in=sum(stem_bytes.values()))
+    if package_path is None:
+        for _ in encoded_stems():
+            pass
+    else:
+        create_zip_package(encoded_stems(), original_name, package_path, profile.label)
+        recorder.add(
+            "package",
+            bytes_in=sum(os.path.getsize(path) for path in encoded.values()),
+            bytes_out=os.path.getsize(package_path),
+        )
+    analyses = {}
+    if analyze:
+        analyses = {
+            analysis_name(name): os.path.join(work_dir, analysis_name(name)) for name in stems
+        }
+    if checkpoint is not None:
+        for files in (encoded, analyses):
+            for name, path in files.items():
+                files[name] = shutil.move(path, os.path.join(out_dir, name))
+    elif decoded is not None:
+        os.remove(decoded)
+
+    # Keep the stems in pipeline order, whatever order they finished encoding
+    order = {os.path.splitext(name)[0]: index for index, name in enumerate(stems)}
+    results = dict(sorted(encoded.items(), key=lambda item: order[os.path.splitext(item[0])[0]]))
+    results.update(analyses)
+    return results
+
+
+def run_job(job_dir, key, profile_name=DEFAULT_PROFILE, output_format=DEFAULT_ENCODER,
+            original_name=None, submitted_at=None, range_workers=1):
+    """
+    Worker entry point: separate a job's input into its folder and cache it
+
+    With an ``original_name`` the ZIP package is written and cached too.
+    ``submitted_at`` is the ``time.time()`` the job was queued at, so the
+    metrics include the wait for a worker. ``range_workers`` is the job's
+    share of the cores for ranges of a large track. A job whose checkpoint is held
+    by another worker waits for that one, then takes its cached result.
+    """
+    profile = get_profile(profile_name)
+    recorder = StageRecorder(measure_memory=True)
+    if submitted_at is not None:
+        recorder.add("queue", max(0.0, time.time() - submitted_at))
+    input_path = os.path.join(job_dir, INPUT_NAME)
+    total_size = os.path.getsize(input_path)
+    write_progress(job_dir, 0.0, "🔍 Analyzing audio spectrum...")
+
+    def preview(path):
+        # Uploads other than WAV are previewed from their decoded copy
+        with recorder.stage("preview"):
+            previews = write_previews(
+                path, job_dir, PREVIEW_SECONDS, profile.stems, PREVIEW_PREFIX,
+                profile.resample_rate,
+            )
+        recorder.add("preview", bytes_out=sum(os.path.getsize(path) for path in previews.values()))
+
+    def report(progress, message):
+        write_progress(job_dir, progress, message)
+
+    def wait():
+        write_progress(job_dir, 0.0, "⏳ Waiting for the same track in another session...")
+
+    package = None
+    if original_name is not None:
+        package = os.path.join(job_dir, package_name(original_name))
+    range_executor = None
+    if profile.parallel and range_workers > 1:
+        range_executor = get_range_executor()
+
+    waited_from = time.perf_counter()
+    try:
+        with claim_checkpoint(key, wait) as checkpoint:
+            recorder.add("queue", time.perf_counter() - waited_from)
+            # The job that held the checkpoint may have just cached this result
+            cached = ResultCache().get(key, job_dir)
+            if cached is None:
+                results = separate_file(
+                    input_path, job_dir, profile_name, output_format, original_name or INPUT_NAME,
+                    package, report, range_executor, recorder, checkpoint, analyze=True,
+                    preview=preview if PREVIEW_SECONDS > 0 else None, range_workers=range_workers,
+                )
+    except BrokenProcessPool:
+        discard_executor(range_executor)
+        raise
+    os.remove(input_path)
+    if cached is not None:
+        bytes_out = sum(os.path.getsize(path) for path in cached.values())
+        write_metrics(job_dir, recorder.job_metrics("hit", total_size, bytes_out))
+        return cached
+    if package is not None:
+        results[os.path.basename(package)] = package
+    write_progress(job_dir, 1.0, "📦 Finalizing stems...")
+    with recorder.stage("store"):
+        ResultCache().put(key, results)
+    bytes_out = sum(os.path.getsize(path) for path in results.values())
+    write_metrics(job_dir, recorder.job_metrics("miss", total_size, bytes_out))
+    return results
+
+
+def submit_job(data, settings=(), profile_name=DEFAULT_PROFILE, output_format=DEFAULT_ENCODER,
+               original_name=None):
+    """
+    Queue a separation of the uploaded ``data`` and return its job ID
+
+    ``data`` may be any bytes-like object, such as a memoryview of the
+    upload; it is hashed and written to the job folder without a copy.
+
+    ``settings`` are the user choices that change the output; together with
+    the upload bytes and output format they form the result cache key.
+    ``profile_name`` picks the processing tier and ``output_format`` the
+    encoder; ``original_name`` is the uploaded file's name, used for the
+    package.
+
+    Raises QueueFull when MAX_QUEUED jobs are already waiting.
+    """
+    sweep_jobs()
+    job_id = uuid.uuid4().hex
+    job_dir = os.path.join(JOBS_ROOT, job_id)
+    os.makedirs(job_dir)
+    recorder = StageRecorder()
+    with recorder.stage("cache", len(data)):
+        key = cache_key(data, (*settings, output_format))
+        cached = ResultCache().get(key, job_dir)
+
+    if cached is not None:
+        bytes_out = sum(os.path.getsize(path) for path in cached.values())
+        recorder.add("cache", bytes_out=bytes_out)
+        write_metrics(job_dir, recorder.job_metrics("hit", len(data), bytes_out))
+        future = Future()
+        future.set_result(cached)
+        with _lock:
+            _jobs[job_id] = (job_dir, key, future)
+        return job_id
+
+    # A full queue turns the job away before its upload costs a disk write
+    with _lock:
+        full = len(_queue) >= MAX_QUEUED
+    if not full:
+        with open(os.path.join(job_dir, INPUT_NAME), "wb") as input_file:
+            input_file.write(data)
+        future = Future()
+        with _lock:
+            # Another session may have taken the last place meanwhile
+            full = len(_queue) >= MAX_QUEUED
+            if not full:
+                _jobs[job_id] = (job_dir, key, future)
+                _queue.append(QueuedJob(
+                    job_id, len(data),
+                    (job_dir, key, profile_name, output_format, original_name, time.time()),
+                ))
+    if full:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise QueueFull(f"{MAX_QUEUED} separations are already waiting")
+    dispatch_jobs()
+    return job_id
+
+
+def dispatch_jobs():
+    """
+    Hand queued jobs to the pool while workers and in-flight bytes allow
+
+    The queue is strictly first in, first out: a job that does not fit yet
+    holds back the ones behind it, so large uploads are never starved.
+    """
+    executor = get_executor()
+    admitted = []
+    with _lock:
+        while _queue:
+            job = _queue[0]
+            future = _jobs.get(job.job_id, (None, None, None))[2]
+            if future is None or future.cancelled():
+                _queue.popleft()
+                continue
+            if len(_running) >= JOB_WORKERS:
+                break
+            if _running and sum(_running.values()) + job.size > MAX_INFLIGHT_BYTES:
+                break
+            _queue.popleft()
+            if future.set_running_or_notify_cancel():
+                _running[job.job_id] = job.size
+                # Cores are split between the jobs running now; one that
+                # starts alone may use them all for its ranges
+                share = max(1, min(RANGE_WORKERS, CPU_COUNT // len(_running)))
+                admitted.append((job, future, share))
+        get_registry().set_queue(len(_queue), sum(_running.values()))
+
+    for job, future, share in admitted:
+        try:
+            try:
+                worker = executor.submit(run_job, *job.args, share)
+            except BrokenProcessPool:
+                # A worker died since the last job was handed out
+                discard_executor(executor)
+                executor = get_executor()
+                worker = executor.submit(run_job, *job.args, share)
+        except Exception as error:
+            finish_job(job.job_id, future, error)
+            continue
+        worker.add_done_callback(partial(finish_job, job.job_id, future, executor=executor))
+
+
+def finish_job(job_id, future, worker, executor=None):
+    """
+    Pass a pool result (or an error) on to the job's future and admit the next job
+
+    A job that failed because its worker died takes its pool, ``executor``,
+    with it; the next job starts a fresh one.
+    """
+    with _lock:
+        _running.pop(job_id, None)
+    if isinstance(worker, Exception):
+        future.set_exception(worker)
+    elif worker.exception() is not None:
+        if isinstance(worker.exception(), BrokenProcessPool):
+            discard_executor(executor)
+        future.set_exception(worker.exception())
+    else:
+        future.set_result(worker.result())
+    dispatch_jobs()
+
+
+def queue_position(job_id):
+    """
+    ``(position, estimated seconds until it starts)`` of a queued job, or None
+
+    The estimate spreads the bytes still to be processed ahead of the job
+    over the workers, at the throughput observed so far.
+    """
+    with _lock:
+        ahead = []
+        for job in _queue:
+            if job.job_id == job_id:
+                break
+            ahead.append(job.size)
+        else:
+            return None
+        # A discarded job keeps its worker until the pool notices, but its folder is gone
+        running = [
+            (_jobs[running_id][0], size) for running_id, size in _running.items() if running_id in _jobs
+        ]
+
+    remaining = sum(ahead)
+    for job_dir, size in running:
+        remaining += size * (1.0 - read_progress(job_dir)[0])
+    seconds_per_byte = get_registry().seconds_per_byte()
+    if seconds_per_byte is None:
+        seconds_per_byte = 1 / (get_profile(DEFAULT_PROFILE).target_mb_s * 1e6)
+    return len(ahead) + 1, remaining * seconds_per_byte / JOB_WORKERS
+
+
+def job_status(job_id):
+    """Current state of a job: queued, running, done, failed or missing"""
+    with _lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        return JobStatus("missing", 0.0, "❌ Separation job not found, please start again", {}, None)
+
+    job_dir, _, future = job
+    if future.done():
+        if future.cancelled() or future.exception() is not None:
+            error = "cancelled" if future.cancelled() else future.exception()
+            return JobStatus("failed", 0.0, f"❌ Separation failed: {error}", {}, None)
+        stems = {
+            name: path for name, path in future.result().items()
+            if not name.startswith(("package-", ANALYSIS_PREFIX))
+        }
+        metrics = read_metrics(job_dir)
+        observe_metrics(job_id, metrics)
+        return JobStatus("done", 1.0, "🎉 Professional separation completed!", stems, metrics)
+    if not os.path.exists(os.path.join(job_dir, PROGRESS_NAME)):
+        queued = queue_position(job_id)
+        if queued is not None:
+            position, wait = queued
+            message = f"⏳ In queue: position {position}, starting in about {format_duration(wait)}"
+            return JobStatus("queued", 0.0, message, {}, None)
+        return JobStatus("queued", 0.0, "⏳ Waiting for a free worker...", {}, None)
+
+    progress, message = read_progress(job_dir)
+    return JobStatus("running", progress, message, {}, None)
+
+
+def job_previews(job_id):
+    """``{stem file name: path}`` of the previews a job has published so far"""
+    with _lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        return {}
+    previews = {}
+    for name in STEM_NAMES:
+        path = os.path.join(job[0], PREVIEW_PREFIX + name)
+        if os.path.exists(path):
+            previews[name] = path
+    return previews
+
+
+def job_analyses(job_id):
+    """``{stem file name: path}`` of the analyses of a finished job's stems"""
+    with _lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        return {}
+    analyses = {}
+    for name in STEM_NAMES:
+        path = os.path.join(job[0], analysis_name(name))
+        if os.path.exists(path):
+            analyses[name] = path
+    return analyses
+
+
+def observe_metrics(job_id, metrics):
+    """Add a finished job to the server's metrics, once, and export them"""
+    with _lock:
+        if metrics is None or job_id in _observed:
+            return
+        _observed.add(job_id)
+    registry = get_registry()
+    registry.observe_job(metrics)
+    registry.write()
+
+
+def discard_job(job_id):
+    """Cancel a job if it has not started and delete its folder"""
+    with _lock:
+        job = _jobs.pop(job_id, None)
+        _observed.discard(job_id)
+        for queued in [queued for queued in _queue if queued.job_id == job_id]:
+            _queue.remove(queued)
+    if job is None:
+        return
+    job_dir, _, future = job
+    future.cancel()
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def build_package(job_id, stems, original_name, quality="Professional"):
+    """
+    A finished job's ZIP package
+
+    A package already in the job folder (built earlier or linked from the
+    cache) is reused; otherwise it is written there and cached. Returns
+    ``(path, built)``.
+    """
+    with _lock:
+        job_dir, key, _ = _jobs[job_id]
+    path = os.path.join(job_dir, package_name(original_name))
+    if os.path.exists(path):
+        return path, False
+
+    create_zip_package(stems, original_name, path, quality)
+    ResultCache().add(key, os.path.basename(path), path)
+    return path, True
+
+
+def touch_job(job_id):
+    """
+    Mark a job's results as in use, restarting its TTL
+
+    Returns False when the job or any of its files is gone, e.g. swept
+    after its session sat idle past the TTL.
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        return False
+    job_dir, _, future = job
+    try:
+        os.utime(job_dir)
+    except OSError:
+        return False
+    if future.done() and not future.cancelled() and future.exception() is None:
+        if not all(os.path.exists(path) for path in future.result().values()):
+            return False
+    if time.time() - _last_sweep > SWEEP_INTERVAL:
+        sweep_jobs()
+    return True
+
+
+def sweep_jobs(now=None):
+    """
+    Delete expired job folders, then the least recently used ones over the cap
+
+    Jobs still queued or running are never touched. Folders left behind by
+    an earlier server process are swept by age like any finished job, and
+    so are checkpoints no job has claimed within the TTL.
+    """
+    global _last_sweep
+    now = time.time() if now is None else now
+    _last_sweep = now
+    with _lock:
+        active = {
+            os.path.basename(job_dir) for job_dir, _, future in _jobs.values() if not future.done()
+        }
+    try:
+        names = os.listdir(JOBS_ROOT)
+    except OSError:
+        return
+
+    finished = []
+    for name in names:
+        if name in active:
+            continue
+        path = os.path.join(JOBS_ROOT, name)
+        try:
+            used = os.stat(path).st_mtime
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+        except OSError:
+            continue
+        finished.append((used, size, name))
+
+    total = sum(size for _, size, _ in finished)
+    for used, size, name in sorted(finished):
+        if now - used <= JOB_TTL and total <= JOBS_MAX_BYTES:
+            break
+        discard_job(name)
+        shutil.rmtree(os.path.join(JOBS_ROOT, name), ignore_errors=True)
+        total -= size
+    sweep_checkpoints(JOB_TTL, now)
+
+
+def load_result(path):
+    """
+    Contents of a result file, read through a memory map
+
+    Pages come straight from the page cache into the returned bytes, with
+    no intermediate read buffer.
+    """
+    with open(path, "rb") as result_file:
+        if os.fstat(result_file.fileno()).st_size == 0:
+            return b""
+        with mmap.mmap(result_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return mapped[:]
+
+
+class JobLease:
+    """
+    Ties a job to the session holding this object
+
+    The job is discarded when the lease is released, or when the lease is
+    garbage collected because the session that held it has ended.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self._finalizer = weakref.finalize(self, discard_job, job_id)
+
+    def release(self):
+        """Discard the job now"""
+        self._finalizer()
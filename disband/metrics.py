@@ -0,0 +1,303 @@
+"""
+Per-stage instrumentation and Prometheus export
+
+A worker times each stage of a separation with a StageRecorder: wall and
+CPU seconds plus bytes in and out. Next to the stages it keeps the peak
+memory of the worker process during the job (none for a cache hit) and
+whether the result came from the cache, and the record is saved as JSON in
+the job folder.
+
+The server process folds every finished job into the MetricsRegistry and
+publishes it in the Prometheus text format. The text is rewritten
+atomically to METRICS_FILE after each job, which node_exporter's textfile
+collector can pick up. When DISBAND_METRICS_PORT is set it is also served
+over HTTP at ``/metrics``. Latencies are histograms, so percentiles come
+from ``histogram_quantile``.
+"""
+
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_NAME = "metrics.json"
+METRICS_FILE = os.environ.get(
+    "DISBAND_METRICS_FILE", os.path.join(tempfile.gettempdir(), "disband_metrics.prom")
+)
+# Port of the /metrics endpoint; unset keeps it off
+METRICS_PORT = os.environ.get("DISBAND_METRICS_PORT")
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_registry = None
+_lock = threading.Lock()
+
+
+def reset_peak_rss():
+    """
+    Restart this process's peak memory from its current size
+
+    Pool workers live for many jobs, so their lifetime peak says little
+    about any one of them. Returns False where the kernel does not allow
+    the reset (not Linux, or /proc is read-only).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_bytes():
+    """Peak resident memory of this process since the last reset_peak_rss()"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                # Reported in KiB
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def format_duration(seconds):
+    """Short human-readable duration"""
+    if seconds < 1:
+        return f"{seconds * 1000:.0f} ms"
+    if seconds < 60:
+        return f"{seconds:.1f} s"
+    return f"{seconds / 60:.1f} min"
+
+
+class StageRecorder:
+    """
+    Wall time, CPU time and bytes of each stage of one separation
+
+    CPU time is that of the recording process: stems built or encoded on
+    another pool show up as wall time only. With ``measure_memory`` the
+    process's peak memory is reset, so the record of a computed result
+    carries the peak of this job alone.
+    """
+
+    def __init__(self, measure_memory=False):
+        self.stages = {}
+        self.measures_memory = measure_memory and reset_peak_rss()
+
+    def add(self, name, wall_seconds=0.0, cpu_seconds=0.0, bytes_in=0, bytes_out=0):
+        """Add to a stage's totals, creating it on first use"""
+        stage = self.stages.setdefault(
+            name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "bytes_in": 0, "bytes_out": 0}
+        )
+        stage["wall_seconds"] += wall_seconds
+        stage["cpu_seconds"] += cpu_seconds
+        stage["bytes_in"] += bytes_in
+        stage["bytes_out"] += bytes_out
+
+    @contextmanager
+    def stage(self, name, bytes_in=0):
+        """Time the ``with`` block as part of stage ``name``"""
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu, bytes_in)
+
+    def job_metrics(self, cache, bytes_in, bytes_out):
+        """The record saved for a finished job"""
+        return {
+            "stages": self.stages,
+            "wall_seconds": sum(stage["wall_seconds"] for stage in self.stages.values()),
+            "cpu_seconds": sum(stage["cpu_seconds"] for stage in self.stages.values()),
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            # A hit never ran a separation, so there is no worker peak to report
+            "peak_rss_bytes": peak_rss_bytes() if self.measures_memory and cache == "miss" else None,
+            "cache": cache,
+        }
+
+
+def write_metrics(job_dir, metrics):
+    """Atomically save a job's metrics record"""
+    path = os.path.join(job_dir, METRICS_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as metrics_file:
+        json.dump(metrics, metrics_file)
+    os.replace(path + ".tmp", path)
+
+
+def read_metrics(job_dir):
+    """A job's metrics record, or None if it has not been written"""
+    try:
+        with open(os.path.join(job_dir, METRICS_NAME), encoding="utf-8") as metrics_file:
+            return json.load(metrics_file)
+    except (OSError, ValueError):
+        return None
+
+
+class Histogram:
+    """Cumulative Prometheus histogram"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def render(self, name, labels=""):
+        """Exposition lines for this histogram"""
+        lines = []
+        cumulative = 0
+        separator = "," if labels else ""
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.total}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Totals over every job finished by this server process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.job_seconds = Histogram()
+        self.stage_seconds = {}
+        self.stage_cpu_seconds = {}
+        self.stage_bytes_in = {}
+        self.stage_bytes_out = {}
+        self.cache_requests = {"hit": 0, "miss": 0}
+        self.peak_rss_bytes = 0
+        # Upload bytes and seconds spent processing them, cache misses only
+        self.processed_bytes = 0
+        self.processed_seconds = 0.0
+        self.queued_jobs = 0
+        self.inflight_bytes = 0
+
+    def observe_job(self, metrics):
+        """Fold in one finished job's metrics record"""
+        with self._lock:
+            self.job_seconds.observe(metrics["wall_seconds"])
+            for name, stage in metrics["stages"].items():
+                self.stage_seconds.setdefault(name, Histogram()).observe(stage["wall_seconds"])
+                for totals, key in (
+                    (self.stage_cpu_seconds, "cpu_seconds"),
+                    (self.stage_bytes_in, "bytes_in"),
+                    (self.stage_bytes_out, "bytes_out"),
+                ):
+                    totals[name] = totals.get(name, 0) + stage[key]
+            self.cache_requests[metrics["cache"]] += 1
+            if metrics["peak_rss_bytes"] is not None:
+                self.peak_rss_bytes = max(self.peak_rss_bytes, metrics["peak_rss_bytes"])
+            if metrics["cache"] == "miss":
+                queued = metrics["stages"].get("queue", {}).get("wall_seconds", 0.0)
+                self.processed_bytes += metrics["bytes_in"]
+                self.processed_seconds += metrics["wall_seconds"] - queued
+
+    def set_queue(self, queued_jobs, inflight_bytes):
+        """Record the current queue depth and the upload bytes being processed"""
+        with self._lock:
+            self.queued_jobs = queued_jobs
+            self.inflight_bytes = inflight_bytes
+
+    def average_job_seconds(self):
+        """Mean job latency, or None before the first job"""
+        with self._lock:
+            count = self.job_seconds.count
+            return self.job_seconds.total / count if count else None
+
+    def seconds_per_byte(self):
+        """Observed processing time per upload byte, or None before the first job"""
+        with self._lock:
+            if not self.processed_bytes:
+                return None
+            return self.processed_seconds / self.processed_bytes
+
+    def render(self):
+        """The registry in the Prometheus text exposition format"""
+        with self._lock:
+            lines = [
+                "# HELP disband_job_seconds Separation latency from submission to result",
+                "# TYPE disband_job_seconds histogram",
+                *self.job_seconds.render("disband_job_seconds"),
+                "# HELP disband_stage_seconds Wall time of each separation stage",
+                "# TYPE disband_stage_seconds histogram",
+            ]
+            for name, histogram in sorted(self.stage_seconds.items()):
+                lines.extend(histogram.render("disband_stage_seconds", f'stage="{name}"'))
+            for metric, help_text, totals in (
+                ("disband_stage_cpu_seconds_total", "CPU time of each stage in the job process", self.stage_cpu_seconds),
+                ("disband_stage_bytes_in_total", "Bytes read by each stage", self.stage_bytes_in),
+                ("disband_stage_bytes_out_total", "Bytes written by each stage", self.stage_bytes_out),
+            ):
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} counter")
+                lines.extend(f'{metric}{{stage="{name}"}} {value}' for name, value in sorted(totals.items()))
+            lines.append("# HELP disband_cache_requests_total Separations served from the cache or computed")
+            lines.append("# TYPE disband_cache_requests_total counter")
+            lines.extend(
+                f'disband_cache_requests_total{{result="{result}"}} {count}'
+                for result, count in self.cache_requests.items()
+            )
+            lines.append("# HELP disband_worker_peak_rss_bytes Highest peak memory of one job in a worker process")
+            lines.append("# TYPE disband_worker_peak_rss_bytes gauge")
+            lines.append(f"disband_worker_peak_rss_bytes {self.peak_rss_bytes}")
+            lines.append("# HELP disband_queued_jobs Separations waiting for a worker")
+            lines.append("# TYPE disband_queued_jobs gauge")
+            lines.append(f"disband_queued_jobs {self.queued_jobs}")
+            lines.append("# HELP disband_inflight_bytes Upload bytes of the separations running now")
+            lines.append("# TYPE disband_inflight_bytes gauge")
+            lines.append(f"disband_inflight_bytes {self.inflight_bytes}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=METRICS_FILE):
+        """Atomically replace the metrics file"""
+        text = self.render()
+        with open(path + ".tmp", "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(text)
+        os.replace(path + ".tmp", path)
+
+
+def start_metrics_server(registry, port):
+    """Serve ``registry`` at ``http://0.0.0.0:<port>/metrics`` from a daemon thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_registry():
+    """Registry of this server process, starting the endpoint on first use"""
+    global _registry
+    with _lock:
+        if _registry is None:
+            _registry = MetricsRegistry()
+            if METRICS_PORT:
+                start_metrics_server(_registry, METRICS_PORT)
+        return _registry
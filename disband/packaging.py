@@ -0,0 +1,88 @@
+"""
+ZIP packaging of finished stems
+
+The archive is written to disk one stem at a time, so packaging never holds
+more than a small copy buffer in memory. Each entry picks its own
+compression from a policy keyed by file extension: PCM and already-encoded
+audio barely shrink under DEFLATE and are stored as-is, text is deflated.
+Stems may also arrive one at a time while they are still being encoded.
+"""
+
+import os
+import time
+import uuid
+import zipfile
+
+# (compress_type, compresslevel) per entry extension
+COMPRESSION_POLICY = {
+    ".wav": (zipfile.ZIP_STORED, None),
+    ".flac": (zipfile.ZIP_STORED, None),
+    ".mp3": (zipfile.ZIP_STORED, None),
+    ".txt": (zipfile.ZIP_DEFLATED, 9),
+}
+DEFAULT_COMPRESSION = (zipfile.ZIP_DEFLATED, 6)
+
+# Info file line for each stem, by file name without extension
+STEM_DESCRIPTIONS = {
+    "vocals_hq": "Vocal isolation",
+    "instrumental_hq": "Clean backing",
+    "vocals_clean": "Processed vocals",
+    "karaoke_version": "Singalong ready",
+    "bass": "Bass line",
+    "drums": "Drum kit",
+}
+
+
+def compression_for(filename, policy=COMPRESSION_POLICY):
+    """Compression type and level for one archive entry"""
+    return policy.get(os.path.splitext(filename)[1].lower(), DEFAULT_COMPRESSION)
+
+
+def create_zip_package(stem_files, original_name, path, quality="Professional",
+                       policy=COMPRESSION_POLICY):
+    """
+    Create ZIP with all stems at ``path``
+
+    ``stem_files`` maps archive names to files, or is an iterable of
+    ``(name, path)`` pairs that is consumed as stems become ready. The
+    archive is assembled under a temporary name and renamed into place, so a
+    reader never sees a partial package.
+    """
+    if hasattr(stem_files, "items"):
+        stem_files = stem_files.items()
+    partial = f"{path}.{uuid.uuid4().hex}.partial"
+    names = []
+    try:
+        with zipfile.ZipFile(partial, "w") as zip_file:
+            # Add all stems, streamed from disk
+            for filename, file_path in stem_files:
+                compress_type, level = compression_for(filename, policy)
+                zip_file.write(file_path, filename, compress_type, level)
+                names.append(filename)
+
+            # Add info file
+            files_text = "\n".join(
+                f"- {filename} ({STEM_DESCRIPTIONS.get(os.path.splitext(filename)[0], 'Stem')})"
+                for filename in names
+            )
+            info_text = f"""🎵 DISBAND - Professional Stems
+Created by @jeysshon
+
+Original: {original_name}
+Quality: {quality}
+Stems: {len(names)}
+Date: {time.strftime('%Y-%m-%d %H:%M')}
+
+Files:
+{files_text}
+
+Thank you for using DISBAND!
+@jeysshon
+"""
+            compress_type, level = compression_for("DISBAND_Info.txt", policy)
+            zip_file.writestr("DISBAND_Info.txt", info_text.encode("utf-8"), compress_type, level)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return path
@@ -0,0 +1,494 @@
+"""
+Streaming separation pipeline
+
+Stems are separated from a PCM WAV one block of samples at a time by the
+spectral engine and streamed into one sink per stem, in the input's own
+sample format. Each block is read together with the frames around it
+that the engine needs, so peak memory stays at a few blocks no matter how
+large the file is. A file on disk is memory-mapped rather than read, so
+blocks are views of the page cache until they are converted to floats.
+
+WAV input can be downsampled on the way in by averaging groups of frames,
+which divides the work of every later stage by the same factor.
+
+Large files can instead be cut into ranges of frames, one worker process
+each: every worker maps the same input file and writes all the stems of its
+range in place, so the input is neither copied into shared memory nor
+pickled, and no frame is transformed twice.
+
+Blocks can also be analysed on their way out, so each stem gets a small
+overview for display without being read again.
+
+Because any block can be separated on its own, the first seconds of a
+track can be written as short preview files that match the start of the
+finished stems exactly. Given a checkpoint, the stems are written to files
+that may hold output from an interrupted run. They are cut back to the
+last saved position and separation carries on from there.
+"""
+
+import collections
+import io
+import mmap
+import os
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+
+from disband.analysis import StemAnalysis, analysis_name
+from disband.audio_io import (
+    PCM_DTYPES, float_to_pcm, parse_wav_layout, pcm_to_float, rewrite_wav_header,
+)
+from disband.spectral import SpectralEngine
+from disband.stems import STEM_NAMES
+
+# Bytes of input separated per block; a block's buffers are about 90 times that
+WINDOW_SIZE = 64 * 1024
+
+# Enough of the file to reach the data chunk of any ordinary WAV header
+HEADER_PROBE_SIZE = 64 * 1024
+# Ranges a parallel separation gives each worker, so a slow one holds up less
+RANGES_PER_WORKER = 2
+
+# A PCM WAV opened for separation and how its stems are framed
+Track = namedtuple(
+    "Track",
+    [
+        "read", "frames", "frame_size", "dtype", "sample_rate", "factor", "header", "data_end",
+        "trailer_size", "rewritten",
+    ],
+)
+
+
+def iter_windows(source, length, window_size=WINDOW_SIZE, start=0):
+    """
+    Yield ``(position, window)`` pairs covering the next ``length - start`` bytes
+
+    Positions count from ``start``. Windows are memoryviews over one reused
+    buffer and are only valid until the next one is requested.
+    """
+    buffer = memoryview(bytearray(max(0, min(window_size, length - start))))
+    position = start
+    while position < length:
+        size = min(window_size, length - position)
+        filled = 0
+        while filled < size:
+            count = source.readinto(buffer[filled:size])
+            if not count:
+                raise EOFError(f"Upload ended after {position + filled} of {length} bytes")
+            filled += count
+        yield position, buffer[:size]
+        position += size
+
+
+def map_source(source, total_size):
+    """Read-only memory map of the ``total_size`` bytes of ``source``, or None if it is not a file"""
+    if total_size == 0:
+        return None
+    try:
+        return mmap.mmap(source.fileno(), total_size, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+
+
+def resume_point(checkpoint, sinks, unit, output_size, restore=None):
+    """
+    Input sample bytes already in every sink, by ``checkpoint``; 0 without one
+
+    The saved position is rounded down to a whole ``unit`` and every sink is
+    cut back to ``output_size(position)`` bytes. ``restore(position)`` loads
+    any other state saved with the sinks. If a sink holds less than that, or
+    the state is not there, every sink is emptied and the run starts over.
+    """
+    if checkpoint is None:
+        return 0
+    position = checkpoint.position(sinks)
+    position -= position % unit
+    size = output_size(position) if position else 0
+    if any(sink.seek(0, os.SEEK_END) < size for sink in sinks.values()) or (
+        position and restore is not None and not restore(position)
+    ):
+        position, size = 0, 0
+    for sink in sinks.values():
+        sink.truncate(size)
+        sink.seek(size)
+    return position
+
+
+def decimate(window, dtype, channels, factor):
+    """Average every ``factor`` consecutive frames of a window into one"""
+    frames = np.frombuffer(window, dtype=dtype).reshape(-1, factor, channels)
+    # Summing strided slices is several times faster than sum(axis=1)
+    total = frames[:, 0].astype(np.int64 if dtype.itemsize > 2 else np.int32)
+    for k in range(1, factor):
+        total += frames[:, k]
+    total //= factor
+    return total.astype(dtype)
+
+
+def decimation_factor(layout, resample_rate):
+    """Integer downsampling factor that brings a WAV to ``resample_rate`` or above"""
+    if layout is None or not resample_rate:
+        return 1
+    return max(1, layout.sample_rate // resample_rate)
+
+
+def frame_reader(source, total_size, layout, factor=1):
+    """
+    ``(read, frames)`` for the samples of a WAV file
+
+    ``read(first, last)`` returns frames ``first:last`` as float32
+    ``(frames, channels)``, downsampled by ``factor``, with zeros wherever
+    the range lies outside the ``frames`` the track has.
+    """
+    # The map is closed once the last view of it is dropped
+    mapped = map_source(source, total_size)
+    view = memoryview(mapped) if mapped is not None else None
+    dtype = PCM_DTYPES[layout.sample_width]
+    frame_size = layout.channels * layout.sample_width
+    frames = layout.data_size // frame_size // factor
+
+    def read(first, last):
+        samples = np.zeros((last - first, layout.channels), dtype=np.float32)
+        start, stop = max(first, 0), min(last, frames)
+        if start < stop:
+            offset = layout.data_offset + start * factor * frame_size
+            size = (stop - start) * factor * frame_size
+            if view is not None:
+                raw = view[offset:offset + size]
+            else:
+                source.seek(offset)
+                raw = source.read(size)
+            if factor > 1:
+                raw = decimate(raw, dtype, layout.channels, factor)
+            pcm = np.frombuffer(raw, dtype=dtype).reshape(-1, layout.channels)
+            samples[start - first:stop - first] = pcm_to_float(pcm)
+        return samples
+
+    return read, frames
+
+
+def open_track(source, total_size, resample_rate=None, frame_limit=None):
+    """
+    The Track of the PCM WAV in ``source``: its samples and the stems' framing
+
+    With ``resample_rate`` the WAV is downsampled to the lowest integer
+    fraction of its rate that stays at or above it. With ``frame_limit``
+    only that many frames are kept. Either way the stems' header is
+    rewritten for the new rate and length, and chunks after the samples are
+    dropped.
+    """
+    source.seek(0)
+    head = source.read(HEADER_PROBE_SIZE)
+    layout = parse_wav_layout(head, total_size)
+    if layout is None:
+        raise ValueError("Stems can only be separated from PCM WAV; decode the file first")
+    frame_size = layout.channels * layout.sample_width
+    factor = decimation_factor(layout, resample_rate)
+    sample_rate = layout.sample_rate // factor
+    read, frames = frame_reader(source, total_size, layout, factor)
+
+    header = bytes(head[:layout.data_offset])
+    data_end = layout.data_offset + layout.data_size
+    trailer_size = total_size - data_end
+    rewritten = factor > 1 or frame_limit is not None
+    if frame_limit is not None:
+        frames = min(frames, frame_limit)
+    if rewritten:
+        out_size = frames * frame_size
+        # RIFF chunks are word aligned
+        trailer_size = out_size & 1
+        header = rewrite_wav_header(
+            header, layout, sample_rate, out_size,
+            layout.data_offset + out_size + trailer_size,
+        )
+    return Track(
+        read, frames, frame_size, PCM_DTYPES[layout.sample_width], sample_rate, factor, header,
+        data_end, trailer_size, rewritten,
+    )
+
+
+def block_frames(track, engine, window_size):
+    """Frames separated per block for about ``window_size`` bytes of input"""
+    return max(window_size // track.frame_size // track.factor, engine.hop_size)
+
+
+def new_analyses(track, engine, names):
+    """An empty StemAnalysis of the track for each stem in ``names``"""
+    return {
+        name: StemAnalysis(track.frames, track.sample_rate, engine.frame_size, engine.hop_size)
+        for name in names
+    }
+
+
+def analysis_state_path(checkpoint, name):
+    """Where ``checkpoint`` keeps the unfinished analysis of stem ``name``"""
+    return os.path.join(checkpoint.directory, analysis_name(name) + ".state")
+
+
+def separate_blocks(track, engine, sinks, first, last, block, analyses=None):
+    """
+    Separate frames ``first:last`` into ``sinks`` block by block
+
+    Each sink is written from where it stands. Every block is folded into
+    ``analyses`` too, when given. Yields the frame each block ends at.
+    """
+    def on_spectrum(name, start, spectrum):
+        analyses[name].add_spectrum(start, spectrum)
+
+    for start in range(first, last, block):
+        stop = min(start + block, last)
+        stems = engine.separate(
+            track.read(*engine.input_range(start, stop)), start, stop,
+            on_spectrum if analyses else None,
+        )
+        for name, sink in sinks.items():
+            if analyses:
+                analyses[name].add_samples(start, stems[name])
+            sink.write(float_to_pcm(stems[name], track.dtype))
+        yield stop
+
+
+def write_trailer(source, track, sinks, window_size=WINDOW_SIZE):
+    """Append what follows the samples to every sink: the input's chunks, or padding"""
+    if track.rewritten:
+        trailer = [b"\0"] if track.trailer_size else []
+    else:
+        source.seek(track.data_end)
+        trailer = (window for _, window in iter_windows(source, track.trailer_size, window_size))
+    for window in trailer:
+        for sink in sinks.values():
+            sink.write(window)
+
+
+def run_pipeline(source, total_size, sinks, window_size=WINDOW_SIZE, on_progress=None,
+                 resample_rate=None, checkpoint=None, frame_limit=None, analysis_dir=None):
+    """
+    Separate the PCM WAV in ``source`` into ``sinks``, block by block
+
+    ``source`` is a seekable binary file of ``total_size`` bytes and
+    ``sinks`` maps stem names to writable binary files. Each block covers
+    about ``window_size`` bytes of input. ``on_progress(done_bytes,
+    data_size)`` is called after every block. Stems keep the input's sample
+    format; its header and trailing chunks are copied verbatim, unless
+    ``resample_rate`` or ``frame_limit`` change them (see open_track).
+
+    With a ``checkpoint`` the sinks are seekable files that may already hold
+    output from an earlier run. Blocks up to its saved position are
+    skipped, and the position is saved again as blocks are written.
+
+    With an ``analysis_dir`` every stem's analysis is written there once it
+    is complete; a checkpoint saves the unfinished analyses alongside.
+    """
+    track = open_track(source, total_size, resample_rate, frame_limit)
+    frame_size = track.frame_size
+    engine = SpectralEngine(track.sample_rate, sinks)
+    analyses = new_analyses(track, engine, sinks) if analysis_dir is not None else {}
+
+    def restore(position):
+        return all(
+            analysis.restore(analysis_state_path(checkpoint, name), position // frame_size)
+            for name, analysis in analyses.items()
+        )
+
+    start = resume_point(
+        checkpoint, sinks, frame_size, lambda position: len(track.header) + position, restore
+    ) // frame_size
+    if not start:
+        for sink in sinks.values():
+            sink.write(track.header)
+
+    saved = start
+    block = block_frames(track, engine, window_size)
+    for last in separate_blocks(track, engine, sinks, start, track.frames, block, analyses):
+        if on_progress:
+            on_progress(last * frame_size, track.frames * frame_size)
+        if checkpoint is not None and (last - saved) * frame_size >= checkpoint.interval:
+            for sink in sinks.values():
+                sink.flush()
+            for name, analysis in analyses.items():
+                analysis.save_state(analysis_state_path(checkpoint, name), last)
+            checkpoint.save(sinks, last * frame_size)
+            saved = last
+    for name, analysis in analyses.items():
+        analysis.write(os.path.join(analysis_dir, analysis_name(name)))
+    write_trailer(source, track, sinks, window_size)
+
+
+def separate_to_directory(source, total_size, out_dir, window_size=WINDOW_SIZE, on_progress=None,
+                          stem_names=STEM_NAMES, resample_rate=None, checkpoint=None, analyze=False):
+    """
+    Write the ``stem_names`` stems of ``source`` into ``out_dir`` and return their paths
+
+    With a ``checkpoint`` for ``out_dir``, stems it marks finished are left
+    as they are and the others carry on from its saved position. With
+    ``analyze`` each stem's analysis is written next to it.
+    """
+    paths = {name: os.path.join(out_dir, name) for name in stem_names}
+    pending = [name for name in paths if checkpoint is None or not checkpoint.is_finished(name)]
+    if not pending:
+        return paths
+    sinks = {name: open(paths[name], "a+b" if checkpoint else "wb") for name in pending}
+    try:
+        run_pipeline(
+            source, total_size, sinks, window_size, on_progress, resample_rate, checkpoint,
+            analysis_dir=out_dir if analyze else None,
+        )
+    finally:
+        for sink in sinks.values():
+            sink.close()
+    if checkpoint is not None:
+        for name in pending:
+            checkpoint.finish(name)
+    return paths
+
+
+def write_previews(input_path, out_dir, seconds, stem_names=STEM_NAMES, prefix="preview-",
+                   resample_rate=None):
+    """
+    Write the first ``seconds`` of each stem of a PCM WAV as short WAVs
+
+    They match the start of the stems separated with the same
+    ``resample_rate`` exactly. Files appear
+    atomically as ``<prefix><stem name>`` in ``out_dir``. Returns ``{name:
+    path}``, empty when the input is not a PCM WAV.
+    """
+    total_size = os.path.getsize(input_path)
+    with open(input_path, "rb") as source:
+        layout = parse_wav_layout(source.read(HEADER_PROBE_SIZE), total_size)
+        if layout is None:
+            return {}
+        paths = {name: os.path.join(out_dir, prefix + name) for name in stem_names}
+        sinks = {name: open(path + ".tmp", "wb") for name, path in paths.items()}
+        try:
+            factor = decimation_factor(layout, resample_rate)
+            run_pipeline(
+                source, total_size, sinks, resample_rate=resample_rate,
+                frame_limit=int(seconds * layout.sample_rate) // factor,
+            )
+        finally:
+            for sink in sinks.values():
+                sink.close()
+    for path in paths.values():
+        os.replace(path + ".tmp", path)
+    return paths
+
+
+def separate_range(input_path, paths, first, last, window_size=WINDOW_SIZE, analyze=False,
+                   resample_rate=None):
+    """
+    Worker entry point: separate frames ``first:last`` of the file at ``input_path``
+
+    Every stem in ``paths`` is written in place, at the range's own offset
+    in its file, which must already be that long. Frames count at the
+    ``resample_rate`` the stems are written at. Returns the analyses of the
+    range with ``analyze``, to be merged with the other ranges'.
+    """
+    with open(input_path, "rb") as source:
+        track = open_track(source, os.path.getsize(input_path), resample_rate)
+        engine = SpectralEngine(track.sample_rate, paths)
+        analyses = new_analyses(track, engine, paths) if analyze else {}
+        sinks = {name: open(path, "r+b") for name, path in paths.items()}
+        try:
+            for sink in sinks.values():
+                sink.seek(len(track.header) + first * track.frame_size)
+            block = block_frames(track, engine, window_size)
+            for _ in separate_blocks(track, engine, sinks, first, last, block, analyses):
+                pass
+        finally:
+            for sink in sinks.values():
+                sink.close()
+    return analyses
+
+
+def separate_in_parallel(input_path, total_size, out_dir, executor, workers, window_size=WINDOW_SIZE,
+                         on_progress=None, stem_names=STEM_NAMES, resample_rate=None, checkpoint=None,
+                         analyze=False):
+    """
+    Write the ``stem_names`` stems of the file at ``input_path`` into ``out_dir``, a range per worker
+
+    The track is cut into a few contiguous ranges for each of the
+    ``workers``, and no more than ``workers`` of them are handed to
+    ``executor`` at a time. Every worker maps the file itself and
+    separates all the stems of its range, so the spectra and features each
+    stem is built from are computed once per frame, as in one pass. With a
+    ``checkpoint`` the run resumes from its saved position, which moves on
+    as the ranges before it finish. ``on_progress(done, total)`` is called
+    as each range finishes. ``resample_rate`` is applied as in run_pipeline.
+    """
+    paths = {name: os.path.join(out_dir, name) for name in stem_names}
+    pending = {
+        name: path for name, path in paths.items()
+        if checkpoint is None or not checkpoint.is_finished(name)
+    }
+    if not pending:
+        return paths
+    sinks = {name: open(path, "a+b" if checkpoint else "wb") for name, path in pending.items()}
+    try:
+        with open(input_path, "rb") as source:
+            track = open_track(source, total_size, resample_rate)
+            frame_size = track.frame_size
+            engine = SpectralEngine(track.sample_rate, pending)
+            analyses = new_analyses(track, engine, pending) if analyze else {}
+
+            def restore(position):
+                return all(
+                    analysis.restore(analysis_state_path(checkpoint, name), position // frame_size)
+                    for name, analysis in analyses.items()
+                )
+
+            start = resume_point(
+                checkpoint, sinks, frame_size, lambda position: len(track.header) + position, restore
+            ) // frame_size
+            if not start:
+                for sink in sinks.values():
+                    sink.write(track.header)
+            # Room for every range, so workers can write theirs in place
+            for sink in sinks.values():
+                sink.flush()
+                sink.truncate(len(track.header) + track.frames * frame_size)
+
+            block = block_frames(track, engine, window_size)
+            size = max(block, -(-(track.frames - start) // (workers * RANGES_PER_WORKER)))
+            ranges = collections.deque(
+                (first, min(first + size, track.frames)) for first in range(start, track.frames, size)
+            )
+            futures = {}
+            finished = {}
+            done = saved = start
+            while ranges or futures:
+                while ranges and len(futures) < workers:
+                    first, last = ranges.popleft()
+                    futures[executor.submit(
+                        separate_range, input_path, pending, first, last, window_size, analyze,
+                        resample_rate,
+                    )] = (first, last)
+                future = next(iter(wait(futures, return_when=FIRST_COMPLETED).done))
+                first, last = futures.pop(future)
+                finished[first] = (last, future.result())
+                done += last - first
+                if on_progress:
+                    on_progress(done * frame_size, track.frames * frame_size)
+                # Analyses and the checkpoint only ever cover the ranges from the start on
+                while start in finished:
+                    start, parts = finished.pop(start)
+                    for name, part in parts.items():
+                        analyses[name].merge(part)
+                if checkpoint is not None and (start - saved) * frame_size >= checkpoint.interval:
+                    for name, analysis in analyses.items():
+                        analysis.save_state(analysis_state_path(checkpoint, name), start)
+                    checkpoint.save(pending, start * frame_size)
+                    saved = start
+            for name, analysis in analyses.items():
+                analysis.write(os.path.join(out_dir, analysis_name(name)))
+            # The trailer goes after the samples the workers wrote
+            for sink in sinks.values():
+                sink.seek(0, os.SEEK_END)
+            write_trailer(source, track, sinks, window_size)
+    finally:
+        for sink in sinks.values():
+            sink.close()
+    if checkpoint is not None:
+        for name in pending:
+            checkpoint.finish(name)
+    return paths
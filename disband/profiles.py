@@ -0,0 +1,74 @@
+"""
+Processing tiers behind the Quality selector
+
+Each tier is a concrete processing profile: how large a window the pipeline
+reads, which stems it builds, whether WAV input is downsampled first, whether a
+large track may be separated in ranges across processes, and whether the
+worker reports progress after every window or only at the start and end.
+
+``target_mb_s`` is the throughput each tier is expected to sustain, in MB of
+upload per second for one job on one core. It is measured on a 16-bit stereo
+44.1 kHz WAV read from the page cache.
+
+Windows are small on purpose. A block's working set (its float frames,
+their spectra and one stem at a time) is about 90 times the input it
+covers, and blocks of 64 KiB separate as fast as blocks of a megabyte. At
+that size a job stays under 10 MB of buffers however large the upload is.
+
+Separation is bound by the FFTs: each stem costs one inverse transform on
+top of the shared forward one, so tiers with fewer stems run faster. At
+these targets an hour of audio separates in one to two minutes.
+``resample_rate`` halves the work again at the cost of the top octave: Fast
+separates 44.1 and 48 kHz input at half its rate, so its stems stop at
+about 11 kHz.
+"""
+
+from collections import namedtuple
+
+from disband.stems import STEM_NAMES
+
+ProcessingProfile = namedtuple(
+    "ProcessingProfile",
+    ["label", "window_size", "stems", "resample_rate", "parallel", "report_progress", "target_mb_s"],
+)
+
+PROFILES = {
+    # Every stem
+    "maximum": ProcessingProfile(
+        label="Maximum",
+        window_size=64 * 1024,
+        stems=STEM_NAMES,
+        resample_rate=None,
+        parallel=True,
+        report_progress=True,
+        target_mb_s=6,
+    ),
+    # The classic four stems: vocals, instrumental, bass and drums
+    "balanced": ProcessingProfile(
+        label="Balanced",
+        window_size=64 * 1024,
+        stems=["vocals_hq.wav", "instrumental_hq.wav", "bass.wav", "drums.wav"],
+        resample_rate=None,
+        parallel=True,
+        report_progress=True,
+        target_mb_s=7,
+    ),
+    # Vocals and instrumental only, at half the sample rate, in one process,
+    # no progress pacing
+    "fast": ProcessingProfile(
+        label="Fast",
+        window_size=64 * 1024,
+        stems=["vocals_hq.wav", "instrumental_hq.wav"],
+        resample_rate=22050,
+        parallel=False,
+        report_progress=False,
+        target_mb_s=16,
+    ),
+}
+
+DEFAULT_PROFILE = "maximum"
+
+
+def get_profile(name):
+    """Profile for a tier name, falling back to the default tier"""
+    return PROFILES.get(name, PROFILES[DEFAULT_PROFILE])
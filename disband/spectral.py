@@ -0,0 +1,92 @@
+"""
+Short-time Fourier transform engine
+
+A track is cut into Hann-windowed frames of FRAME_SIZE samples every
+HOP_SIZE samples, each frame is transformed, its bins are weighted by the
+stem masks, and the stems are transformed back and overlap-added. All
+frames of a block go through NumPy's FFT at once.
+
+Frame ``k`` always covers samples ``k * HOP_SIZE`` onwards, counted from
+the start of the track. A block's output therefore depends only on the
+input around it, and any range can be computed on its own: a block, a
+resumed checkpoint, a preview or a range per worker produces exactly the
+same samples as one pass over the whole track. Memory is bounded by the
+block size.
+
+FRAME_SIZE is set for 44.1 kHz: 46 ms frames resolve voices and bass
+notes while keeping drum hits sharp.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from disband.stems import StemMasks
+
+FRAME_SIZE = 2048
+# Four frames overlap every sample
+HOP_SIZE = FRAME_SIZE // 4
+
+
+class SpectralEngine:
+    """Separates blocks of float samples into the ``names`` stems"""
+
+    def __init__(self, sample_rate, names, frame_size=FRAME_SIZE, hop_size=HOP_SIZE):
+        self.names = list(names)
+        self.frame_size = frame_size
+        self.hop_size = hop_size
+        # Periodic Hann for analysis and synthesis; the overlapping squares sum to a constant
+        self.window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame_size) / frame_size)).astype(np.float32)
+        self.synthesis = self.window * np.float32(hop_size / np.sum(self.window ** 2))
+        self.masks = StemMasks(sample_rate, frame_size)
+
+    def input_range(self, start, stop):
+        """
+        ``(first, last)`` samples of input needed to separate ``start:stop``
+
+        That covers every frame overlapping the range plus the one before
+        the first, which the transient feature compares against.
+        """
+        first_frame = (start - self.frame_size) // self.hop_size + 1
+        last_frame = (stop - 1) // self.hop_size
+        return (first_frame - 1) * self.hop_size, last_frame * self.hop_size + self.frame_size
+
+    def separate(self, samples, start, stop, on_spectrum=None):
+        """
+        Stems of samples ``start:stop`` as ``{name: (stop - start, channels) float32}``
+
+        ``samples`` is ``(frames, channels)`` float32 holding exactly the
+        ``input_range(start, stop)`` samples, zeros outside the track.
+        ``on_spectrum(name, first, spectrum)`` receives each stem's frames
+        that begin inside the range, ``(channels, spectra, bins)`` with the
+        first being frame number ``first``, so every frame is reported once.
+        """
+        first, _ = self.input_range(start, stop)
+        channels = samples.shape[1]
+        frames = sliding_window_view(np.ascontiguousarray(samples.T), self.frame_size, axis=1)
+        spectra = np.fft.rfft(frames[:, ::self.hop_size] * self.window, axis=-1)
+
+        # The first frame is only context; output starts at the second
+        origin = first + self.hop_size
+        overlap = self.frame_size // self.hop_size
+        count = spectra.shape[1] - 1
+        stems = {}
+        # Frames that begin inside the range, as rows of the stem spectra
+        owned = -(-start // self.hop_size)
+        rows = slice(owned - origin // self.hop_size, -(-stop // self.hop_size) - origin // self.hop_size)
+        for name, spectrum in self.masks.build(spectra, self.names):
+            if on_spectrum is not None:
+                on_spectrum(name, owned, spectrum[:, rows])
+            pieces = np.fft.irfft(spectrum, n=self.frame_size, axis=-1)
+            del spectrum
+            pieces *= self.synthesis
+            output = np.zeros((len(pieces), (count + overlap - 1) * self.hop_size), dtype=np.float32)
+            for part in range(overlap):
+                begin = part * self.hop_size
+                output[:, begin:begin + count * self.hop_size] += (
+                    pieces[:, :, begin:begin + self.hop_size].reshape(len(pieces), -1)
+                )
+            output = output[:, start - origin:stop - origin].T
+            if output.shape[1] != channels:
+                output = np.repeat(output, channels, axis=1)
+            stems[name] = np.ascontiguousarray(output)
+        return stems
@@ -0,0 +1,125 @@
+"""
+Stem masks
+
+Every stem is the track's short-time spectrum with each bin weighted by a
+mask. Three features drive the masks:
+
+- center: how alike the left and right channels are in a bin, from 0 to
+  1. Lead vocals are almost always mixed to the center.
+- transient: how sharply a bin's level rose since the previous frame,
+  from 0 to 1. Drum hits are sharp onsets; held and slowly swelling notes
+  are not.
+- bands: smooth weights of the bins inside a frequency range.
+
+Vocals are the center of the vocal range and the instrumental is the rest
+of the track, so the two always add up to the original. Karaoke is the
+classic vocal remover: the side signal plus the bass of the middle. Bass
+and drums are frequency bands split by how transient each bin is.
+
+Tracks that are not stereo have no center to find: their whole vocal
+range counts as vocals, and karaoke equals the instrumental.
+"""
+
+import numpy as np
+
+# Every stem a separation produces, in display order
+STEM_NAMES = [
+    "vocals_hq.wav",
+    "instrumental_hq.wav",
+    "vocals_clean.wav",
+    "karaoke_version.wav",
+    "bass.wav",
+    "drums.wav",
+]
+
+# Frequency ranges in Hz; band edges fade out over half an octave
+VOCAL_BAND = (80.0, 12000.0)
+CLEAN_VOCAL_BAND = (150.0, 8000.0)
+BASS_CUTOFF = 250.0
+KARAOKE_BASS_CUTOFF = 200.0
+CYMBAL_CUTOFF = 5000.0
+# Powers of the center feature: higher keeps only the most centered bins
+VOCAL_CENTER_POWER = 2
+CLEAN_VOCAL_CENTER_POWER = 6
+
+# A bin counts as a full onset once its level is this many times the last frame's
+ONSET_RATIO = 4.0
+
+EPSILON = 1e-9
+
+
+def band_weights(freqs, low=None, high=None):
+    """Weight of each frequency in a band, with raised-cosine edges half an octave wide"""
+    weights = np.ones(len(freqs), dtype=np.float32)
+    octaves = np.log2(np.maximum(freqs, EPSILON))
+    if low is not None:
+        fade = np.clip((octaves - np.log2(low)) * 2 + 1, 0, 1)
+        weights *= 0.5 - 0.5 * np.cos(np.pi * fade)
+    if high is not None:
+        fade = np.clip((np.log2(high) - octaves) * 2 + 1, 0, 1)
+        weights *= 0.5 - 0.5 * np.cos(np.pi * fade)
+    return weights
+
+
+def magnitude(spectrum):
+    """Absolute value of complex bins, computed the same way whatever the array size"""
+    return np.sqrt(spectrum.real ** 2 + spectrum.imag ** 2)
+
+
+class StemMasks:
+    """Builds stem spectra from track spectra for one sample rate and frame size"""
+
+    def __init__(self, sample_rate, frame_size):
+        freqs = np.fft.rfftfreq(frame_size, 1.0 / sample_rate)
+        self.vocal_band = band_weights(freqs, *VOCAL_BAND)
+        self.clean_vocal_band = band_weights(freqs, *CLEAN_VOCAL_BAND)
+        self.bass_band = band_weights(freqs, high=BASS_CUTOFF)
+        self.karaoke_bass_band = band_weights(freqs, high=KARAOKE_BASS_CUTOFF)
+        self.cymbal_band = band_weights(freqs, low=CYMBAL_CUTOFF)
+
+    def build(self, spectra, names):
+        """
+        Yield ``(name, spectrum)`` of each stem in ``names``, one at a time
+
+        ``spectra`` is ``(channels, frames + 1, bins)``; its first frame only
+        serves as the previous frame of the second, for the transient
+        feature. Each stem is ``(channels, frames, bins)``, or one channel
+        when it is the same in every channel. Only the shared features stay
+        in memory between stems.
+        """
+        previous = spectra[:, :-1]
+        spectra = spectra[:, 1:]
+        mid = spectra.mean(axis=0, keepdims=True)
+        if len(spectra) == 2:
+            left, right = spectra
+            power = (left.real ** 2 + left.imag ** 2) + (right.real ** 2 + right.imag ** 2)
+            center = np.clip(2 * (left * right.conj()).real / (power + EPSILON), 0, 1)
+        else:
+            center = np.ones(spectra.shape[1:], dtype=np.float32)
+
+        level = magnitude(mid[0])
+        previous_level = magnitude(previous.mean(axis=0))
+        transient = np.clip(1 - ONSET_RATIO * previous_level / (level + EPSILON), 0, 1)
+        steady = 1 - transient
+        vocals = mid * (center ** VOCAL_CENTER_POWER * self.vocal_band * steady)
+
+        for name in names:
+            if name == "vocals_hq.wav":
+                yield name, vocals
+            elif name == "instrumental_hq.wav":
+                yield name, spectra - vocals
+            elif name == "vocals_clean.wav":
+                yield name, mid * (center ** CLEAN_VOCAL_CENTER_POWER * self.clean_vocal_band * steady)
+            elif name == "karaoke_version.wav":
+                if len(spectra) == 2:
+                    side = (spectra[0] - spectra[1]) * 0.5
+                    bass = mid[0] * self.karaoke_bass_band
+                    yield name, np.stack([bass + side, bass - side])
+                else:
+                    yield name, spectra - vocals
+            elif name == "bass.wav":
+                yield name, spectra * (self.bass_band * steady)
+            elif name == "drums.wav":
+                yield name, spectra * np.maximum(self.cymbal_band, transient)
+            else:
+                raise ValueError(f"Unknown stem: {name}")
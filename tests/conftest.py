@@ -0,0 +1,20 @@
+"""
+Test settings
+
+Every result store the package finds through its environment is pointed
+at a scratch folder before ``disband`` is imported, so tests never touch
+the caches of a server running on the same machine.
+"""
+
+import os
+import sys
+import tempfile
+
+SCRATCH = tempfile.mkdtemp(prefix="disband_tests_")
+os.environ["DISBAND_CACHE_DIR"] = os.path.join(SCRATCH, "cache")
+os.environ["DISBAND_CHECKPOINT_DIR"] = os.path.join(SCRATCH, "checkpoints")
+os.environ["DISBAND_METRICS_FILE"] = os.path.join(SCRATCH, "metrics.prom")
+os.environ.pop("DISBAND_METRICS_PORT", None)
+os.environ.pop("DISBAND_DOWNLOADS_PORT", None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
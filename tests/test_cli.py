@@ -0,0 +1,26 @@
+from disband.cli import find_tracks, main
+
+
+def test_inputs_without_audio_are_reported(tmp_path):
+    music = tmp_path / "music"
+    music.mkdir()
+    (music / "song.wav").write_bytes(b"")
+    notes = tmp_path / "notes"
+    notes.mkdir()
+    (notes / "readme.txt").write_text("not audio")
+
+    tracks, unmatched = find_tracks(
+        [str(music), str(notes), str(tmp_path / "typo"), str(tmp_path / "*.mp3")]
+    )
+
+    assert tracks == [(str(music / "song.wav"), "song.wav")]
+    assert unmatched == [str(notes), str(tmp_path / "typo"), str(tmp_path / "*.mp3")]
+
+
+def test_run_with_no_matching_input_fails(tmp_path, capsys):
+    missing = str(tmp_path / "typo.wav")
+
+    assert main([missing, "-o", str(tmp_path / "out")]) == 1
+    output = capsys.readouterr()
+    assert missing in output.err
+    assert "Nothing to do" not in output.out
@@ -0,0 +1,167 @@
+import collections
+import io
+import os
+import shutil
+import signal
+import uuid
+import wave
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pytest
+
+from disband import jobs
+from disband.profiles import PROFILES
+
+
+class PendingExecutor:
+    """Pool whose jobs never finish, so they stay running"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        self.submitted.append(args)
+        return Future()
+
+
+@pytest.fixture
+def queue(monkeypatch, tmp_path):
+    """An empty job queue with one worker and no real pool"""
+    monkeypatch.setattr(jobs, "JOBS_ROOT", str(tmp_path))
+    monkeypatch.setattr(jobs, "JOB_WORKERS", 1)
+    monkeypatch.setattr(jobs, "_jobs", {})
+    monkeypatch.setattr(jobs, "_queue", collections.deque())
+    monkeypatch.setattr(jobs, "_running", {})
+    executor = PendingExecutor()
+    monkeypatch.setattr(jobs, "get_executor", lambda: executor)
+    return executor
+
+
+@pytest.fixture
+def pool(monkeypatch, tmp_path):
+    """An empty job queue in front of a real job pool of its own"""
+    monkeypatch.setattr(jobs, "JOBS_ROOT", str(tmp_path))
+    monkeypatch.setattr(jobs, "_jobs", {})
+    monkeypatch.setattr(jobs, "_queue", collections.deque())
+    monkeypatch.setattr(jobs, "_running", {})
+    monkeypatch.setattr(jobs, "_executor", None)
+    yield
+    if jobs._executor is not None:
+        jobs._executor.shutdown()
+
+
+def wav_upload(seconds, sample_rate=44100):
+    """A 16-bit stereo WAV upload of a tone"""
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((8000 * np.sin(2 * np.pi * 440 * t)).repeat(2).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+def test_queued_job_behind_a_running_one(queue):
+    running = jobs.submit_job(b"first upload", original_name="first.wav")
+    queued = jobs.submit_job(b"second upload", original_name="second.wav")
+
+    assert running in jobs._running
+    assert jobs.queue_position(queued)[0] == 1
+    assert jobs.job_status(queued).state == "queued"
+
+
+def test_full_queue_turns_a_job_away_before_writing_it(queue, monkeypatch, tmp_path):
+    monkeypatch.setattr(jobs, "MAX_QUEUED", 1)
+    jobs.submit_job(b"running upload", original_name="first.wav")
+    jobs.submit_job(b"queued upload", original_name="second.wav")
+    written = []
+    monkeypatch.setattr(jobs, "open", lambda path, *args: written.append(path), raising=False)
+
+    with pytest.raises(jobs.QueueFull):
+        jobs.submit_job(b"third upload", original_name="third.wav")
+
+    assert written == []
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_discarding_a_running_job_keeps_the_queue_readable(queue):
+    running = jobs.submit_job(b"first upload", original_name="first.wav")
+    queued = jobs.submit_job(b"second upload", original_name="second.wav")
+
+    # The session of the running job goes away while the pool still works on it
+    jobs.discard_job(running)
+
+    assert running in jobs._running
+    status = jobs.job_status(queued)
+    assert status.state == "queued"
+    assert "position 1" in status.message
+
+
+def test_jobs_share_the_cores_for_their_ranges(queue, monkeypatch):
+    monkeypatch.setattr(jobs, "CPU_COUNT", 4)
+    monkeypatch.setattr(jobs, "JOB_WORKERS", 4)
+    monkeypatch.setattr(jobs, "RANGE_WORKERS", 4)
+
+    for index in range(3):
+        jobs.submit_job(b"upload %d" % index, original_name=f"track{index}.wav")
+
+    # The run_job argument after submitted_at
+    assert [args[-1] for args in queue.submitted] == [4, 2, 1]
+
+
+def test_killed_worker_does_not_break_later_jobs(pool):
+    broken = jobs.get_executor()
+    os.kill(broken.submit(os.getpid).result(timeout=60), signal.SIGKILL)
+    with pytest.raises(BrokenProcessPool):
+        while True:
+            broken.submit(int).result(timeout=60)
+
+    job_id = jobs.submit_job(wav_upload(0.1), ("test",), "fast", original_name="track.wav")
+
+    results = jobs._jobs[job_id][2].result(timeout=120)
+    assert set(PROFILES["fast"].stems) <= set(results)
+    assert jobs.get_executor() is not broken
+
+
+def test_job_whose_worker_died_discards_its_pool(queue, monkeypatch):
+    broken = object()
+    monkeypatch.setattr(jobs, "_executor", broken)
+    worker = Future()
+    worker.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+    future = Future()
+    future.set_running_or_notify_cancel()
+
+    jobs.finish_job("job", future, worker, executor=broken)
+
+    assert jobs._executor is None
+    assert isinstance(future.exception(), BrokenProcessPool)
+
+
+def test_upload_that_is_not_wav_gets_previews(monkeypatch, tmp_path):
+    decoded = str(tmp_path / "decoded.wav")
+    t = np.arange(44100) / 44100
+    with wave.open(decoded, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(44100)
+        wav.writeframes((8000 * np.sin(2 * np.pi * 440 * t)).repeat(2).astype("<i2").tobytes())
+    job_dir = tmp_path / "job"
+    job_dir.mkdir()
+    (job_dir / jobs.INPUT_NAME).write_bytes(b"ID3" + bytes(1000))
+    # Stands in for ffmpeg
+    monkeypatch.setattr(jobs, "can_decode", lambda: True)
+    monkeypatch.setattr(jobs, "decode_to_wav", lambda source, target: shutil.copyfile(decoded, target))
+
+    results = jobs.run_job(str(job_dir), uuid.uuid4().hex, "fast", "wav", "song.mp3")
+
+    for name in PROFILES["fast"].stems:
+        # The track is shorter than a preview, so each preview is its whole stem
+        with wave.open(str(job_dir / (jobs.PREVIEW_PREFIX + name))) as preview:
+            with wave.open(results[name]) as stem:
+                # One second at the rate the tier separates at
+                frames = stem.getframerate()
+                assert preview.getnframes() == stem.getnframes() == frames
+                assert preview.readframes(frames) == stem.readframes(frames)
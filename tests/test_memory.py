@@ -0,0 +1,53 @@
+import os
+import tracemalloc
+import wave
+
+import numpy as np
+import pytest
+
+from disband.jobs import separate_file
+from disband.profiles import PROFILES
+
+SAMPLE_RATE = 44100
+# Many times any profile's window, so one input-sized buffer would show
+INPUT_SIZE = 12 * 1024 * 1024
+
+
+@pytest.fixture(scope="module")
+def large_wav(tmp_path_factory):
+    """A 16-bit stereo WAV of INPUT_SIZE bytes, written a second at a time"""
+    path = str(tmp_path_factory.mktemp("input") / "large.wav")
+    rng = np.random.default_rng(0)
+    frames = INPUT_SIZE // 4
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        for start in range(0, frames, SAMPLE_RATE):
+            t = np.arange(start, min(start + SAMPLE_RATE, frames)) / SAMPLE_RATE
+            tone = 6000 * np.sin(2 * np.pi * 220 * t)
+            noise = rng.normal(0, 500, (len(t), 2))
+            wav.writeframes((tone[:, None] + noise).astype("<i2").tobytes())
+    return path
+
+
+@pytest.mark.parametrize(
+    "profile_name, output_format",
+    # FLAC is encoded the same way in every tier; the fastest keeps the test short
+    [*((name, "wav") for name in sorted(PROFILES)), ("fast", "flac")],
+)
+def test_job_never_holds_an_input_sized_buffer(large_wav, tmp_path, profile_name, output_format):
+    assert PROFILES[profile_name].window_size * 8 < os.path.getsize(large_wav)
+
+    tracemalloc.start()
+    try:
+        results = separate_file(
+            large_wav, str(tmp_path), profile_name, output_format,
+            package_path=str(tmp_path / "stems.zip"), analyze=True,
+        )
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert len(results) == 2 * len(PROFILES[profile_name].stems)
+    assert peak < os.path.getsize(large_wav)
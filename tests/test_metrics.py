@@ -0,0 +1,36 @@
+import resource
+
+import numpy as np
+import pytest
+
+from disband.metrics import MetricsRegistry, StageRecorder
+
+MB = 1024 * 1024
+
+
+def test_peak_memory_is_the_jobs_own():
+    # An earlier job in the same worker that touched far more memory
+    earlier = np.ones(256 * MB // 8)
+    del earlier
+    lifetime_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    recorder = StageRecorder(measure_memory=True)
+    if not recorder.measures_memory:
+        pytest.skip("the kernel does not let this process reset its peak memory")
+    with recorder.stage("separate"):
+        job = np.ones(16 * MB // 8)
+    peak = recorder.job_metrics("miss", job.nbytes, job.nbytes)["peak_rss_bytes"]
+
+    assert job.nbytes < peak < lifetime_peak - 128 * MB
+
+
+def test_cache_hits_have_no_peak_memory():
+    registry = MetricsRegistry()
+    miss = StageRecorder(measure_memory=True).job_metrics("miss", 10, 10)
+    hit = StageRecorder(measure_memory=True).job_metrics("hit", 10, 10)
+    assert hit["peak_rss_bytes"] is None
+
+    registry.observe_job(miss)
+    registry.observe_job(hit)
+    assert registry.peak_rss_bytes == (miss["peak_rss_bytes"] or 0)
+    assert f"disband_worker_peak_rss_bytes {registry.peak_rss_bytes}" in registry.render()
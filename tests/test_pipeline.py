@@ -0,0 +1,167 @@
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from disband.checkpoints import Checkpoint
+from disband.pipeline import separate_in_parallel, separate_range, separate_to_directory
+
+SAMPLE_RATE = 44100
+WINDOW_SIZE = 16 * 1024
+
+
+@pytest.fixture(scope="module")
+def track(tmp_path_factory):
+    """Two seconds of 16-bit stereo WAV followed by a LIST chunk"""
+    path = str(tmp_path_factory.mktemp("input") / "track.wav")
+    rng = np.random.default_rng(1)
+    t = np.arange(2 * SAMPLE_RATE) / SAMPLE_RATE
+    tone = 8000 * np.sin(2 * np.pi * 330 * t)[:, None] + rng.normal(0, 800, (len(t), 2))
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(tone.astype("<i2").tobytes())
+    with open(path, "r+b") as wav:
+        wav.seek(0, os.SEEK_END)
+        wav.write(b"LIST" + struct.pack("<I", 4) + b"disb")
+        size = wav.tell()
+        wav.seek(4)
+        wav.write(struct.pack("<I", size - 8))
+    return path
+
+
+def one_pass(track, out_dir, resample_rate=None):
+    out_dir.mkdir()
+    with open(track, "rb") as source:
+        separate_to_directory(
+            source, os.path.getsize(track), str(out_dir), WINDOW_SIZE, resample_rate=resample_rate,
+            analyze=True,
+        )
+    return read_outputs(out_dir)
+
+
+def read_outputs(out_dir):
+    """Bytes of every stem and arrays of every analysis in a folder"""
+    outputs = {}
+    for name in sorted(os.listdir(out_dir)):
+        path = os.path.join(out_dir, name)
+        if name.endswith(".wav"):
+            with open(path, "rb") as stem:
+                outputs[name] = stem.read()
+        elif name.endswith(".npz"):
+            with np.load(path) as analysis:
+                outputs[name] = {key: analysis[key].tolist() for key in analysis.files}
+    return outputs
+
+
+class FailingExecutor(ThreadPoolExecutor):
+    """
+    Runs ranges in threads, except that every range from ``cutoff`` on fails
+
+    They fail once ``checkpoint`` has saved a position, like a worker killed
+    after the ranges before it finished.
+    """
+
+    def __init__(self, cutoff, checkpoint):
+        super().__init__(max_workers=2)
+        self.cutoff = cutoff
+        self.checkpoint = checkpoint
+
+    def submit(self, fn, *args):
+        if fn is separate_range and args[2] >= self.cutoff:
+            return super().submit(self.killed)
+        return super().submit(fn, *args)
+
+    def killed(self):
+        deadline = time.monotonic() + 30
+        while not self.checkpoint.position(["vocals_hq.wav"]) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        raise RuntimeError("worker killed")
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    """Runs ranges in threads and keeps the most that were ever running at once"""
+
+    def __init__(self, max_workers):
+        super().__init__(max_workers)
+        self.lock = threading.Lock()
+        self.running = self.most = 0
+
+    def submit(self, fn, *args):
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+        future = super().submit(fn, *args)
+        future.add_done_callback(self.finished)
+        return future
+
+    def finished(self, future):
+        with self.lock:
+            self.running -= 1
+
+
+@pytest.mark.parametrize("resample_rate", [None, 22050])
+def test_parallel_ranges_match_one_pass(track, tmp_path, resample_rate):
+    expected = one_pass(track, tmp_path / "one_pass", resample_rate)
+    out_dir = tmp_path / "parallel"
+    out_dir.mkdir()
+    with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("spawn")) as executor:
+        separate_in_parallel(
+            track, os.path.getsize(track), str(out_dir), executor, 2, WINDOW_SIZE,
+            resample_rate=resample_rate, analyze=True,
+        )
+    outputs = read_outputs(out_dir)
+    assert outputs == expected
+    # Two seconds at the rate the stems were separated at
+    with wave.open(str(out_dir / "vocals_hq.wav"), "rb") as stem:
+        assert stem.getframerate() == (resample_rate or SAMPLE_RATE)
+        assert stem.getnframes() == 2 * stem.getframerate()
+
+
+def test_parallel_run_keeps_to_its_workers(track, tmp_path):
+    expected = one_pass(track, tmp_path / "one_pass")
+    out_dir = tmp_path / "parallel"
+    out_dir.mkdir()
+
+    with CountingExecutor(4) as executor:
+        separate_in_parallel(
+            track, os.path.getsize(track), str(out_dir), executor, 2, WINDOW_SIZE, analyze=True,
+        )
+    assert executor.most == 2
+    assert read_outputs(out_dir) == expected
+
+
+def test_parallel_run_resumes_after_a_failed_range(track, tmp_path):
+    expected = one_pass(track, tmp_path / "one_pass")
+    out_dir = tmp_path / "checkpoint"
+    out_dir.mkdir()
+    checkpoint = Checkpoint(str(out_dir), interval=1)
+    progress = []
+
+    # Four ranges of half a second: the last two never finish
+    with FailingExecutor(SAMPLE_RATE, checkpoint) as executor, pytest.raises(RuntimeError):
+        separate_in_parallel(
+            track, os.path.getsize(track), str(out_dir), executor, 2, WINDOW_SIZE,
+            on_progress=lambda done, total: progress.append((done, total)), checkpoint=checkpoint,
+            analyze=True,
+        )
+    saved = checkpoint.position(["vocals_hq.wav"])
+    assert 0 < saved <= SAMPLE_RATE * 4
+
+    with ThreadPoolExecutor(2) as executor:
+        separate_in_parallel(
+            track, os.path.getsize(track), str(out_dir), executor, 2, WINDOW_SIZE,
+            on_progress=lambda done, total: progress.append((done, total)), checkpoint=checkpoint,
+            analyze=True,
+        )
+    assert checkpoint.is_finished("vocals_hq.wav")
+    assert progress[-1][0] == progress[-1][1]
+    outputs = read_outputs(out_dir)
+    assert {name: outputs[name] for name in expected} == expected
@@ -0,0 +1,117 @@
+import io
+import wave
+
+import numpy as np
+import pytest
+
+from disband.pipeline import run_pipeline
+from disband.spectral import FRAME_SIZE, HOP_SIZE, SpectralEngine
+from disband.stems import STEM_NAMES, StemMasks
+
+SAMPLE_RATE = 44100
+
+# Lengths around every boundary of the frame layout: empty, a hop, a frame
+# and one sample either side of each, plus a few frames with a ragged end
+LENGTHS = [
+    0, 1, HOP_SIZE - 1, HOP_SIZE, HOP_SIZE + 1, FRAME_SIZE - 1, FRAME_SIZE, FRAME_SIZE + 1,
+    3 * FRAME_SIZE + 7, 20 * HOP_SIZE,
+]
+
+
+def make_track(length, channels=2, seed=0):
+    """``(length, channels)`` float32 of a tone, a few clicks and noise"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(length) / SAMPLE_RATE
+    tone = 0.3 * np.sin(2 * np.pi * 220 * t)
+    clicks = np.where(np.arange(length) % 3000 == 100, 0.5, 0.0)
+    samples = np.stack([tone * (1 - 0.2 * c) + clicks for c in range(channels)], axis=1)
+    samples += rng.normal(0, 0.02, samples.shape)
+    return samples.astype(np.float32)
+
+
+def reference_separate(samples, names):
+    """
+    Stems of a whole track, one frame and one sample at a time
+
+    The definition the vectorized engine has to match: every frame is
+    windowed, transformed and masked against the frame before it, then
+    transformed back and added into the output where it began.
+    """
+    length, channels = samples.shape
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(FRAME_SIZE) / FRAME_SIZE)).astype(np.float32)
+    synthesis = window * np.float32(HOP_SIZE / np.sum(window ** 2))
+    masks = StemMasks(SAMPLE_RATE, FRAME_SIZE)
+
+    def frame_spectrum(k):
+        frame = np.zeros((channels, FRAME_SIZE), dtype=np.float32)
+        for offset in range(FRAME_SIZE):
+            position = k * HOP_SIZE + offset
+            if 0 <= position < length:
+                frame[:, offset] = samples[position]
+        return np.fft.rfft(frame * window, axis=-1)
+
+    outputs = {name: np.zeros((length, channels)) for name in names}
+    if not length:
+        return outputs
+    # Every frame that overlaps the track
+    for k in range((0 - FRAME_SIZE) // HOP_SIZE + 1, (length - 1) // HOP_SIZE + 1):
+        pair = np.stack([frame_spectrum(k - 1), frame_spectrum(k)], axis=1)
+        for name, spectrum in masks.build(pair, names):
+            piece = np.fft.irfft(spectrum[:, 0], n=FRAME_SIZE, axis=-1) * synthesis
+            for offset in range(FRAME_SIZE):
+                position = k * HOP_SIZE + offset
+                if 0 <= position < length:
+                    # A stem with one channel is the same in every channel
+                    outputs[name][position] += piece[:, offset]
+    return outputs
+
+
+def engine_separate(samples, names):
+    """Stems of a whole track from the engine in one call"""
+    engine = SpectralEngine(SAMPLE_RATE, names)
+    length = len(samples)
+    first, last = engine.input_range(0, length)
+    padded = np.zeros((last - first, samples.shape[1]), dtype=np.float32)
+    padded[-first:-first + length] = samples
+    return engine.separate(padded, 0, length)
+
+
+def wav_bytes(samples):
+    """A 16-bit PCM WAV of float samples"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(samples.shape[1])
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes((samples * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+def pipeline_stems(data, window_size):
+    """Bytes of every stem file the pipeline writes for the WAV ``data``"""
+    sinks = {name: io.BytesIO() for name in STEM_NAMES}
+    run_pipeline(io.BytesIO(data), len(data), sinks, window_size)
+    return {name: sink.getvalue() for name, sink in sinks.items()}
+
+
+@pytest.mark.parametrize("length", LENGTHS)
+@pytest.mark.parametrize("channels", [1, 2])
+def test_engine_matches_frame_by_frame_reference(length, channels):
+    samples = make_track(length, channels)
+    expected = reference_separate(samples, STEM_NAMES)
+    stems = engine_separate(samples, STEM_NAMES)
+
+    assert list(stems) == STEM_NAMES
+    for name in STEM_NAMES:
+        assert stems[name].shape == (length, channels)
+        assert stems[name].dtype == np.float32
+        np.testing.assert_allclose(stems[name], expected[name], atol=1e-5, err_msg=name)
+
+
+@pytest.mark.parametrize("length", LENGTHS)
+def test_block_size_does_not_change_output(length):
+    data = wav_bytes(make_track(length))
+    whole = pipeline_stems(data, 1024 * 1024)
+    # One hop per block, the smallest the pipeline uses, and an uneven size
+    for window_size in (HOP_SIZE * 4, 3 * HOP_SIZE * 4 + 4):
+        assert pipeline_stems(data, window_size) == whole